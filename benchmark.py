@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+
+# Measure convert_to_git.py and create_libraries.py against generated svn repositories.
+# Everything runs locally through svnadmin and file:// URLs, and the same options always
+# generate the same repository, so numbers can be compared from one run to the next.
+
+import sys, os, subprocess, getopt, random, hashlib, shutil, json, time, resource, stat
+from distutils.spawn import find_executable
+from collections import namedtuple
+
+usagestr = \
+"""
+Usage: python benchmark.py [options] [WORKDIR]
+
+Generate an svn repository in WORKDIR (default benchmark_work), convert it with
+convert_to_git.py and with the create_libraries.py workflow, and report revisions
+per second, peak memory and the number of svn and git processes started.
+
+Repository options:
+  --revisions N     Number of revisions (default 200)
+  --files N         Files in the project tree (default 100)
+  --externals N     Externals defined on the project (default 3)
+  --nesting N       Levels of externals inside externals (default 1)
+  --pinned F        Fraction of externals pinned to a revision, 0 to 1 (default 0.5)
+  --moves N         Number of times a directory is moved (default 2)
+  --binaries N      Number of large binary files added (default 2)
+  --binary-size KB  Size of each binary file (default 1024)
+  --seed N          Random seed (default 1)
+
+Run options:
+  --repeat N        Convert N times (default 1)
+  --convert-args A  Extra arguments for convert_to_git.py, e.g. "--fast-import --jobs 4"
+  --skip-libraries  Don't run the create_libraries.py workflow
+  --output FILE     Also write the results to FILE as JSON
+""".strip()
+
+def usagequit(message):
+    print message
+    print usagestr
+    sys.exit(2)
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+RepoOptions = namedtuple("RepoOptions", ["revisions", "files", "externals", "nesting", "pinned", "moves", "binaries", "binarysize", "seed"])
+Result = namedtuple("Result", ["workflow", "run", "revisions", "seconds", "maxrss", "processes", "head"])
+
+#
+# Dump stream writer
+#
+
+def writeRecord(out, headers, props=None, text=None):
+    """Write one dump record. Props are a complete property list."""
+    propdata = ""
+    if props is not None:
+        propdata = "".join("K %d\n%s\nV %d\n%s\n" % (len(key), key, len(value), value) for key, value in sorted(props.iteritems()))
+        propdata += "PROPS-END\n"
+        headers.append(("Prop-content-length", len(propdata)))
+    if text is not None:
+        headers.append(("Text-content-length", len(text)))
+        headers.append(("Text-content-md5", hashlib.md5(text).hexdigest()))
+    if props is not None or text is not None:
+        headers.append(("Content-length", len(propdata) + len(text or "")))
+    for key, value in headers:
+        out.write("%s: %s\n" % (key, value))
+    out.write("\n")
+    out.write(propdata)
+    if text is not None:
+        out.write(text)
+    out.write("\n\n")
+
+def binaryData(seed, size):
+    """Reproducible incompressible bytes."""
+    chunks = []
+    counter = 0
+    while size > 0:
+        chunk = hashlib.sha256("%s:%d" % (seed, counter)).digest()
+        chunks.append(chunk[:size])
+        size -= len(chunk)
+        counter += 1
+    return "".join(chunks)
+
+#
+# Repository generator
+#
+
+class RepoGenerator(object):
+    """Builds a repository history revision by revision and writes it as a dump.
+
+    /trunk/app is the project being converted. It uses /libs/libN through
+    svn:externals, and the first level of libraries use the next level, as deep
+    as --nesting asks for."""
+    def __init__(self, options, url):
+        self.options = options
+        self.url = url
+        self.random = random.Random(options.seed)
+        self.revnum = 0
+        self.files = {}
+        self.dirs = set()
+        self.externs = {}
+        self.libraries = ["lib%d" % i for i in xrange(options.externals * max(options.nesting, 1))]
+        self.pinned = set(library for library in self.libraries if self.random.random() < options.pinned)
+        self.appdirs = ["/trunk/app"] + ["/trunk/app/dir%d" % i for i in xrange(max(options.files / 20, 1))]
+
+    def text(self):
+        lines = ["line %d %08x" % (i, self.random.getrandbits(32)) for i in xrange(self.random.randint(5, 40))]
+        return "\n".join(lines) + "\n"
+
+    def startRevision(self, out, message):
+        self.revnum += 1
+        props = {   'svn:author': self.random.choice(['alice', 'bob', 'carol']),
+                    'svn:date': time.strftime("%Y-%m-%dT%H:%M:%S.000000Z", time.gmtime(1262304000 + self.revnum * 3600)),
+                    'svn:log': message }
+        writeRecord(out, [("Revision-number", self.revnum)], props)
+
+    def addDir(self, out, path):
+        self.dirs.add(path)
+        writeRecord(out, [("Node-path", path.lstrip('/')), ("Node-kind", "dir"), ("Node-action", "add")], {})
+
+    def putFile(self, out, path, data):
+        action = "change" if path in self.files else "add"
+        self.files[path] = data
+        writeRecord(out, [("Node-path", path.lstrip('/')), ("Node-kind", "file"), ("Node-action", action)], {} if action == "add" else None, data)
+
+    def setExterns(self, out, path, lines):
+        self.externs[path] = lines
+        writeRecord(out, [("Node-path", path.lstrip('/')), ("Node-kind", "dir"), ("Node-action", "change")], {'svn:externals': "\n".join(lines) + "\n"})
+
+    def move(self, out, source, target):
+        writeRecord(out, [("Node-path", target.lstrip('/')), ("Node-kind", "dir"), ("Node-action", "add"),
+                          ("Node-copyfrom-rev", self.revnum - 1), ("Node-copyfrom-path", source.lstrip('/'))])
+        writeRecord(out, [("Node-path", source.lstrip('/')), ("Node-action", "delete")])
+        for table in (self.files, self.externs):
+            for path in list(table):
+                if path == source or path.startswith(source + '/'):
+                    table[target + path[len(source):]] = table.pop(path)
+        for path in list(self.dirs):
+            if path == source or path.startswith(source + '/'):
+                self.dirs.discard(path)
+                self.dirs.add(target + path[len(source):])
+        self.appdirs = [target + path[len(source):] if path == source or path.startswith(source + '/') else path for path in self.appdirs]
+
+    def externLines(self, children):
+        lines = []
+        for child in children:
+            url = "%s/libs/%s" % (self.url, child)
+            if child in self.pinned:
+                lines.append("-r %d %s %s" % (self.revnum - 1, url, child))
+            else:
+                lines.append("%s %s" % (url, child))
+        return lines
+
+    def defineExterns(self, out):
+        """(Re)write every svn:externals definition, which also moves the pinned ones."""
+        count = self.options.externals
+        if not count:
+            return
+        self.setExterns(out, "/trunk/app", self.externLines(self.libraries[:count]))
+        for i, library in enumerate(self.libraries[:-count]):
+            self.setExterns(out, "/libs/%s" % library, self.externLines([self.libraries[i + count]]))
+
+    def write(self, out):
+        options = self.options
+        out.write("SVN-fs-dump-format-version: 2\n\n")
+        out.write("UUID: 00000000-0000-0000-0000-%012d\n\n" % options.seed)
+        writeRecord(out, [("Revision-number", 0)], {'svn:date': "2010-01-01T00:00:00.000000Z"})
+
+        # Layout and initial content
+        self.startRevision(out, "Create layout")
+        for path in ["/trunk", "/libs"] + self.appdirs:
+            self.addDir(out, path)
+        for library in self.libraries:
+            self.addDir(out, "/libs/%s" % library)
+            for i in xrange(5):
+                self.putFile(out, "/libs/%s/file%d.c" % (library, i), self.text())
+        for i in xrange(options.files):
+            self.putFile(out, "%s/file%d.c" % (self.random.choice(self.appdirs), i), self.text())
+        remaining = options.revisions - 1
+        if remaining <= 0:
+            return
+
+        # Spread the interesting events over the history
+        events = {}
+        def schedule(kind, count):
+            for i in xrange(count):
+                events.setdefault(2 + (i + 1) * remaining / (count + 1), []).append(kind)
+        # The first definition creates the externs, the later ones move the pinned ones
+        schedule('externs', 5 if options.externals else 0)
+        schedule('move', options.moves)
+        schedule('binary', options.binaries)
+        moves = 0
+        binaries = 0
+
+        while self.revnum < options.revisions:
+            revnum = self.revnum + 1
+            kinds = events.get(revnum, [])
+            self.startRevision(out, "Revision %d: %s" % (revnum, ", ".join(kinds) or "edit"))
+            if 'externs' in kinds:
+                self.defineExterns(out)
+            if 'move' in kinds and len(self.appdirs) > 1:
+                source = self.random.choice(self.appdirs[1:])
+                target = "/trunk/app/moved%d" % moves
+                moves += 1
+                self.move(out, source, target)
+            if 'binary' in kinds:
+                self.putFile(out, "/trunk/app/blob%d.bin" % binaries, binaryData("%d:%d" % (options.seed, binaries), options.binarysize * 1024))
+                binaries += 1
+            if not kinds:
+                if self.libraries and self.random.random() < 0.3:
+                    library = self.random.choice(self.libraries)
+                    self.putFile(out, "/libs/%s/file%d.c" % (library, self.random.randint(0, 4)), self.text())
+                else:
+                    sources = sorted(path for path in self.files if path.startswith("/trunk/") and path.endswith(".c"))
+                    for path in self.random.sample(sources, min(3, len(sources))):
+                        self.putFile(out, path, self.text())
+
+def makeRepository(options, path):
+    """Create the repository at path, unless one from the same options is already there."""
+    stamp = os.path.join(path, "benchmark_options.json")
+    if os.path.exists(stamp):
+        with open(stamp, 'r') as f:
+            if json.load(f) == options._asdict():
+                return
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        shutil.rmtree(path)
+    print "-- Generating %d revisions in %s --" % (options.revisions, path)
+    subprocess.check_call(['svnadmin', 'create', path])
+    url = "file://" + os.path.abspath(path)
+    dumpfile = path + ".dump"
+    with open(dumpfile, 'wb') as out:
+        RepoGenerator(options, url).write(out)
+    with open(dumpfile, 'rb') as dump:
+        subprocess.check_call(['svnadmin', 'load', '-q', path], stdin=dump)
+    os.remove(dumpfile)
+    with open(stamp, 'w') as f:
+        json.dump(options._asdict(), f)
+
+#
+# Measuring
+#
+
+def makeShims(bindir, logfile):
+    """Put svn and git wrappers first on the PATH that log every process they start."""
+    os.makedirs(bindir)
+    for tool in ('svn', 'git'):
+        real = find_executable(tool)
+        shim = os.path.join(bindir, tool)
+        with open(shim, 'w') as f:
+            f.write('#!/bin/sh\necho %s >> "%s"\nexec "%s" "$@"\n' % (tool, logfile, real))
+        os.chmod(shim, os.stat(shim).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+def measure(args, cwd, workdir):
+    """Run args in a child process. Returns (seconds, peak RSS in KB, {tool: processes})."""
+    scratch = os.path.join(workdir, "measure")
+    if os.path.exists(scratch):
+        shutil.rmtree(scratch)
+    logfile = os.path.join(scratch, "processes.log")
+    makeShims(os.path.join(scratch, "bin"), logfile)
+    env = dict(os.environ, PATH=os.path.join(scratch, "bin") + os.pathsep + os.environ.get('PATH', ''))
+    statsfile = os.path.join(scratch, "rusage.json")
+    # The child reports its own children's peak memory, so every workflow is measured on its own.
+    start = time.time()
+    subprocess.check_call([sys.executable, os.path.abspath(__file__), '--measure-child', statsfile, '--'] + args, cwd=cwd, env=env)
+    seconds = time.time() - start
+    with open(statsfile, 'r') as f:
+        maxrss = json.load(f)['maxrss']
+    processes = {'svn': 0, 'git': 0}
+    if os.path.exists(logfile):
+        with open(logfile, 'r') as f:
+            for line in f:
+                processes[line.strip()] = processes.get(line.strip(), 0) + 1
+    return seconds, maxrss, processes
+
+def measureChild(statsfile, args):
+    retval = subprocess.call(args)
+    with open(statsfile, 'w') as f:
+        json.dump({'maxrss': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}, f)
+    sys.exit(retval)
+
+def gitHead(path):
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=path).strip()
+
+def writeUsers(path):
+    with open(path, 'w') as f:
+        for user in ('alice', 'bob', 'carol'):
+            f.write("%s = %s <%s@example.com>\n" % (user, user.capitalize(), user))
+
+def runConvert(options, workdir, url, users, run, convertargs):
+    target = os.path.join(workdir, "convert_%d" % run)
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    args = [sys.executable, os.path.join(here, 'convert_to_git.py'), '--root', url, '--repo', '/trunk/app', '--users', users]
+    args += convertargs + [target]
+    seconds, maxrss, processes = measure(args, workdir, workdir)
+    return Result(workflow='convert_to_git', run=run, revisions=options.revisions, seconds=seconds, maxrss=maxrss,
+                  processes=processes, head=gitHead(target))
+
+def runLibraries(options, workdir, url, users, run, libraries):
+    target = os.path.join(workdir, "libraries_%d" % run)
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    script = ("import sys; sys.path.insert(0, %r); import create_libraries; "
+              "create_libraries.createlibraries(%r, %r, targetdir=%r, gitusers=%r, converttogit=%r, jobs=1)"
+              % (here, url, dict((library, "/libs/%s/" % library) for library in libraries), target, users,
+                 "%s %s" % (sys.executable, os.path.join(here, 'convert_to_git.py'))))
+    seconds, maxrss, processes = measure([sys.executable, '-c', script], workdir, workdir)
+    return Result(workflow='create_libraries', run=run, revisions=options.revisions, seconds=seconds, maxrss=maxrss,
+                  processes=processes, head=gitHead(os.path.join(target, 'libraries')))
+
+def report(results):
+    print "\n-- Benchmark results --"
+    print "%-17s %4s %9s %10s %10s %8s %8s  %s" % ("workflow", "run", "seconds", "revs/sec", "peak RSS", "svn", "git", "HEAD")
+    for result in results:
+        print "%-17s %4d %9.2f %10.2f %8d MB %8d %8d  %s" % (result.workflow, result.run, result.seconds,
+                                                             result.revisions / result.seconds, result.maxrss / 1024,
+                                                             result.processes.get('svn', 0), result.processes.get('git', 0), result.head[:12])
+    for workflow in sorted(set(result.workflow for result in results)):
+        heads = set(result.head for result in results if result.workflow == workflow)
+        if len(heads) > 1:
+            print "WARNING: %s produced different histories from the same repository" % workflow
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3 and sys.argv[1] == '--measure-child' and sys.argv[3] == '--':
+        measureChild(sys.argv[2], sys.argv[4:])
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], '', ['revisions=', 'files=', 'externals=', 'nesting=', 'pinned=', 'moves=',
+                                                      'binaries=', 'binary-size=', 'seed=', 'repeat=', 'convert-args=',
+                                                      'skip-libraries', 'output='])
+    except getopt.GetoptError as err:
+        usagequit(str(err))
+    if len(args) > 1:
+        usagequit("Too many arguments, only need one directory.")
+    workdir = os.path.abspath(args[0] if args else 'benchmark_work')
+
+    values = {'revisions': 200, 'files': 100, 'externals': 3, 'nesting': 1, 'pinned': 0.5, 'moves': 2,
+              'binaries': 2, 'binarysize': 1024, 'seed': 1}
+    repeat = 1
+    convertargs = []
+    skiplibraries = False
+    outputfile = None
+    for o, a in opts:
+        name = o[2:].replace('-', '')
+        try:
+            if name in values:
+                values[name] = float(a) if name == 'pinned' else int(a)
+            elif o == '--repeat':
+                repeat = int(a)
+        except ValueError:
+            usagequit("%s needs a number" % o)
+        if o == '--convert-args':
+            convertargs = a.split()
+        elif o == '--skip-libraries':
+            skiplibraries = True
+        elif o == '--output':
+            outputfile = a
+    options = RepoOptions(**values)
+
+    for tool in ('svn', 'svnadmin', 'git'):
+        if not find_executable(tool):
+            usagequit("%s needs to be installed" % tool)
+
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    repopath = os.path.join(workdir, "repo")
+    makeRepository(options, repopath)
+    url = "file://" + repopath
+    users = os.path.join(workdir, "gitusers.txt")
+    writeUsers(users)
+    libraries = ["lib%d" % i for i in xrange(options.externals * max(options.nesting, 1))]
+
+    results = []
+    for run in xrange(repeat):
+        results.append(runConvert(options, workdir, url, users, run, convertargs))
+        if libraries and not skiplibraries:
+            results.append(runLibraries(options, workdir, url, users, run, libraries))
+    report(results)
+    if outputfile:
+        with open(outputfile, 'w') as f:
+            json.dump({'options': options._asdict(), 'results': [result._asdict() for result in results]}, f, indent=2)
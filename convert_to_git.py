@@ -1,7 +1,19 @@
 #!/usr/bin/env python
 
-import sys, os, shutil, subprocess, re, getopt, signal, shlex, functools
-from collections import namedtuple
+import sys, os, shutil, subprocess, re, getopt, shlex, functools, tempfile, urllib
+import stat, hashlib, calendar, datetime, bisect, shelve, threading, posixpath, cStringIO, sqlite3
+import time, json, contextlib, Queue, select, errno
+from multiprocessing.pool import ThreadPool
+import svndump, git_date_merge
+from collections import namedtuple, OrderedDict
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+try:
+    import svn.core, svn.client, svn.ra, svn.wc
+except ImportError:
+    svn = None
 
 #
 # Input parameter related functions
@@ -10,6 +22,7 @@ from collections import namedtuple
 usagestr = \
 """
 Usage: python convert-to-git.py --root ROOTURL --repo SUBREPO [--remote REMOTEURL ...] DIRECTORY
+       python convert-to-git.py --root ROOTURL --target SUBREPO:PREFIX:DIRECTORY [--target ...]
 
 Convert a subdirectory SUBREPO of an svn repository ROOTURL to a git repository at DIRECTORY.
 Merge in all externals as if they had been developed in this directory 
@@ -20,6 +33,56 @@ Options:
   --remote      Add a remote mirror; If this script encounters an extern that points to one
                 of these remotes, instead it will pull from the local repository specified 
                 by --root.
+  --fast-import Stream commits into a single 'git fast-import' process instead of
+                staging the whole work tree with 'git add' for every revision.
+  --prefix      Write the converted project into this subdirectory of the git repo,
+                as if it had always been developed there.
+  --jobs        Number of externals to check out or switch at the same time (default 1)
+  --dump        Read the history from an 'svnadmin dump' or 'svnrdump dump' stream
+                (FILE, or - for stdin) instead of asking svn. Implies --fast-import.
+                Externals are not followed in this mode.
+  --no-working-copy
+                Keep a plain export of the project instead of an svn working copy, and
+                only fetch the files each revision changed. Externals are still
+                checked out as working copies.
+  --shards      Split the history into N revision ranges, convert them at the same
+                time in separate processes, and chain them back into one history,
+                the same one a single process would have made. Implies --fast-import.
+  --range       Only convert revisions FIRST:LAST, starting from a fresh checkout of FIRST.
+  --externals-dump
+                Read which revisions changed svn:externals on which directories from
+                an 'svnadmin dump' stream (FILE, or - for stdin) instead of working it
+                out from the log, which can't tell svn:externals from other properties.
+  --target      Convert SUBREPO into the git repo at DIRECTORY, under PREFIX (which may be
+                empty). Give it more than once to convert several projects of the same
+                repository in one pass over its history, instead of one pass each.
+                Implies --fast-import and --no-working-copy.
+  --prefetch    With --no-working-copy, fetch the files of up to N upcoming revisions
+                from svn on a separate thread while the current one is committed
+                (default 4, 0 turns it off).
+  --extern-cache
+                Keep snapshots of pinned externs in DIRECTORY as git trees, and put
+                ones seen before straight into the commit instead of fetching them
+                from svn again. Several conversions can share the same DIRECTORY.
+  --metrics     Append one JSON line per replayed revision to FILE, with the wall time,
+                subprocesses started and bytes read for each phase of the replay.
+  --find-rev    Print the git commit that svn revision REV ended up in, and exit.
+                Only needs DIRECTORY.
+  --follow      Keep running once the history is converted, and convert every new
+                revision of the repository as soon as it shows up.
+  --poll        With --follow, how many seconds to wait between looking for new
+                revisions (default 10).
+  --notify      Wake up the --follow conversion into DIRECTORY so it looks for new
+                revisions right away, and exit. Meant for the svn mirror's
+                post-commit and post-revprop-change hooks.
+  --svn-backend How to talk to svn: 'subprocess' runs the svn command line client for
+                every query (default), 'session' keeps one session per repository
+                open through Subversion's Python bindings for the whole conversion.
+  --svn-timeout Kill an svn command that runs for longer than SECONDS (a log that
+                stops sending anything for that long), and start it again. Only
+                with --svn-backend subprocess. Off by default.
+  --svn-retries How many times to start a timed out svn command again before
+                giving up (default 2).
 
 """.strip()
 def usage():
@@ -32,7 +95,7 @@ def usagequit(message):
 
 def parseOptions():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], '', ['root=', 'repo=', 'remote=', 'users=', 'ancestry', 'no-externals'])
+        opts, args = getopt.getopt(sys.argv[1:], '', ['root=', 'repo=', 'remote=', 'users=', 'ancestry', 'no-externals', 'fast-import', 'dump=', 'jobs=', 'prefix=', 'svn-backend=', 'find-rev=', 'metrics=', 'no-working-copy', 'shards=', 'range=', 'externals-dump=', 'extern-cache=', 'target=', 'prefetch=', 'follow', 'poll=', 'notify', 'svn-timeout=', 'svn-retries='])
     except getopt.GetoptError as err:
         usagequit(str(err))
 
@@ -50,6 +113,25 @@ def parseOptions():
     usersfile = None
     checkancestry = False
     exportexternals = True
+    fastimport = False
+    dumpfile = None
+    jobs = 1
+    prefix = ''
+    svnbackend = 'subprocess'
+    findrev = None
+    metricsfile = None
+    exporttree = False
+    shards = 1
+    revrange = None
+    externalsdump = None
+    externcache = None
+    targets = []
+    prefetchdepth = 4
+    follow = False
+    pollseconds = 10
+    notify = False
+    svntimeout = None
+    svnretries = 2
     for o, a in opts:
         if o == '--root':
             rootrepo = a
@@ -63,15 +145,100 @@ def parseOptions():
             checkancestry = True
         elif o == '--no-externals':
             exportexternals = False
+        elif o == '--fast-import':
+            fastimport = True
+        elif o == '--dump':
+            dumpfile = a
+            fastimport = True
+        elif o == '--prefix':
+            prefix = a.strip('/')
+        elif o == '--jobs':
+            try:
+                jobs = int(a)
+            except ValueError:
+                usagequit("--jobs needs a number")
+        elif o == '--svn-backend':
+            if a not in ('subprocess', 'session'):
+                usagequit("--svn-backend must be 'subprocess' or 'session'")
+            if a == 'session' and svn is None:
+                usagequit("--svn-backend session needs Subversion's Python bindings (import svn.client failed)")
+            svnbackend = a
+        elif o == '--shards':
+            try:
+                shards = int(a)
+            except ValueError:
+                usagequit("--shards needs a number")
+            fastimport = True
+        elif o == '--range':
+            match = re.search(r'^([0-9]+):([0-9]+)$', a)
+            if not match:
+                usagequit("--range needs FIRST:LAST revision numbers")
+            revrange = (int(match.group(1)), int(match.group(2)))
+        elif o == '--no-working-copy':
+            exporttree = True
+        elif o == '--externals-dump':
+            externalsdump = a
+        elif o == '--extern-cache':
+            externcache = os.path.abspath(a)
+        elif o == '--prefetch':
+            try:
+                prefetchdepth = int(a)
+            except ValueError:
+                usagequit("--prefetch needs a number")
+        elif o == '--target':
+            parts = a.split(':', 2)
+            if len(parts) != 3 or not parts[0] or not parts[2]:
+                usagequit("--target needs SUBREPO:PREFIX:DIRECTORY")
+            targets.append((parts[0], parts[1].strip('/'), parts[2]))
+        elif o == '--metrics':
+            metricsfile = a
+        elif o == '--follow':
+            follow = True
+        elif o == '--poll':
+            try:
+                pollseconds = float(a)
+            except ValueError:
+                usagequit("--poll needs a number of seconds")
+        elif o == '--notify':
+            notify = True
+        elif o == '--svn-timeout':
+            try:
+                svntimeout = int(a)
+            except ValueError:
+                usagequit("--svn-timeout needs a number of seconds")
+        elif o == '--svn-retries':
+            try:
+                svnretries = int(a)
+            except ValueError:
+                usagequit("--svn-retries needs a number")
+        elif o == '--find-rev':
+            try:
+                findrev = int(a.lstrip('r'))
+            except ValueError:
+                usagequit("--find-rev needs a revision number")
+            
+    if findrev != None or notify:
+        return None, None, remoterepos, targetdir, usersfile, checkancestry, exportexternals, fastimport, dumpfile, jobs, prefix, svnbackend, findrev, metricsfile, exporttree, shards, revrange, externalsdump, externcache, targets, prefetchdepth, follow, pollseconds, notify, svntimeout, svnretries
             
     if rootrepo == None:
         usagequit("Please specify a root repository with --root")
-    if repo == None:
+    if repo == None and not targets:
         usagequit("Please specify a target sub-repository with --repo")
     if usersfile == None:
         usersfile = 'gitusers.txt'
-    repo = rootrepo + repo
-    return rootrepo, repo, remoterepos, targetdir, usersfile, checkancestry, exportexternals
+    if svntimeout is not None and svnbackend != 'subprocess':
+        usagequit("--svn-timeout only works with --svn-backend subprocess")
+    if follow and (targets or shards > 1 or dumpfile or revrange or checkancestry):
+        usagequit("--follow can't be used with --target, --shards, --dump, --range or --ancestry")
+    if targets:
+        if shards > 1 or dumpfile or revrange or checkancestry:
+            usagequit("--target can't be used with --shards, --dump, --range or --ancestry")
+        fastimport = True
+        exporttree = True
+        targets = [(rootrepo + subrepo, targetprefix, directory) for subrepo, targetprefix, directory in targets]
+    else:
+        repo = rootrepo + repo
+    return rootrepo, repo, remoterepos, targetdir, usersfile, checkancestry, exportexternals, fastimport, dumpfile, jobs, prefix, svnbackend, findrev, metricsfile, exporttree, shards, revrange, externalsdump, externcache, targets, prefetchdepth, follow, pollseconds, notify, svntimeout, svnretries
 
 def getUserLookup(filename):
     userLookup = {}
@@ -89,15 +256,148 @@ def getUserLookup(filename):
 
 
 
+#
+# Instrumentation
+#
+
+class Metrics(object):
+    """Where the time goes: wall time, subprocesses started and bytes read from them,
+    for every phase of every replayed revision.
+    
+    Phases nest, and time is only counted against the innermost one, so the phases
+    of a revision add up to its wall time. Subprocesses started by worker threads
+    count against whatever phase the main loop is in, unless the thread runs in the
+    background with a phase of its own."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stack = []
+        self.output = None
+        self.revnum = None
+        self.revisionStart = None
+        self.phases = {}
+        self.totals = {}
+        self.revisions = []
+
+    def open(self, filename):
+        self.output = open(filename, 'a')
+
+    def stats(self, name, phases=None):
+        if phases is None:
+            phases = self.phases
+        if name not in phases:
+            phases[name] = {'seconds': 0.0, 'processes': 0, 'bytes': 0, 'timeouts': 0}
+        return phases[name]
+
+    def credit(self, now):
+        """Count the time since the innermost phase last started or resumed."""
+        name, resumed = self.stack[-1]
+        self.stats(name)['seconds'] += now - resumed
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        with self.lock:
+            now = time.time()
+            if self.stack:
+                self.credit(now)
+            self.stack.append([name, now])
+        try:
+            yield
+        finally:
+            with self.lock:
+                now = time.time()
+                self.credit(now)
+                self.stack.pop()
+                if self.stack:
+                    self.stack[-1][1] = now
+
+    @contextlib.contextmanager
+    def background(self, name):
+        """Count the subprocesses this thread starts against name. Its time isn't
+        counted, because it overlaps with the main loop's phases."""
+        self.local.phase = name
+        try:
+            yield
+        finally:
+            self.local.phase = None
+
+    def current(self):
+        name = getattr(self.local, 'phase', None)
+        if name is not None:
+            return name
+        return self.stack[-1][0] if self.stack else 'other'
+
+    def recordProcess(self, bytesread=0):
+        with self.lock:
+            stats = self.stats(self.current())
+            stats['processes'] += 1
+            stats['bytes'] += bytesread
+
+    def recordTimeout(self):
+        with self.lock:
+            self.stats(self.current())['timeouts'] += 1
+
+    def fold(self):
+        """Add the phases gathered so far to the run totals and start over."""
+        for name, stats in self.phases.iteritems():
+            total = self.stats(name, self.totals)
+            for key, value in stats.iteritems():
+                total[key] += value
+        self.phases = {}
+
+    def startRevision(self, revnum):
+        with self.lock:
+            self.fold()
+            self.revnum = revnum
+            self.revisionStart = time.time()
+
+    def finishRevision(self):
+        with self.lock:
+            seconds = time.time() - self.revisionStart
+            other = self.stats('other')
+            other['seconds'] += max(0.0, seconds - sum(stats['seconds'] for stats in self.phases.itervalues()))
+            record = {'rev': self.revnum, 'seconds': round(seconds, 3), 'phases': {}}
+            for key in ('processes', 'bytes', 'timeouts'):
+                record[key] = sum(stats[key] for stats in self.phases.itervalues())
+            for name, stats in self.phases.iteritems():
+                record['phases'][name] = dict(stats, seconds=round(stats['seconds'], 3))
+            self.revisions.append((seconds, self.revnum, record['processes']))
+            self.fold()
+            self.revnum = None
+        if self.output:
+            self.output.write(json.dumps(record, sort_keys=True) + "\n")
+            self.output.flush()
+
+    def summary(self, count=10):
+        with self.lock:
+            self.fold()
+        lines = ["-- Slowest revisions --"]
+        for seconds, revnum, processes in sorted(self.revisions, reverse=True)[:count]:
+            lines.append("  r%-8d %9.2fs %6d processes" % (revnum, seconds, processes))
+        lines.append("-- Time by phase --")
+        for name, stats in sorted(self.totals.iteritems(), key=lambda item: item[1]['seconds'], reverse=True):
+            lines.append("  %-12s %9.2fs %6d processes %10.1f MB read %4d timeouts" % (name, stats['seconds'], stats['processes'],
+                                                                                   stats['bytes'] / 1048576.0, stats['timeouts']))
+        return "\n".join(lines)
+
+    def close(self):
+        if self.output:
+            self.output.close()
+            self.output = None
+
+metrics = Metrics()
+
 #
 # Shell command wrappers
 #
 
 class TimeoutException(Exception):
-    def __init__(self, cmd, seconds):
+    """stdout is whatever the command printed before it was killed."""
+    def __init__(self, cmd, seconds, stdout=None):
         Exception.__init__(self, cmd, seconds)
         self.cmd = cmd
         self.seconds = seconds
+        self.stdout = stdout
     def __str__(self):
         return "Command '%s' timed out after %d seconds." % (self.cmd, self.seconds)
     
@@ -114,45 +414,47 @@ class CalledProcessError(subprocess.CalledProcessError):
     def __str__(self):
         return subprocess.CalledProcessError.__str__(self) + ':\n%s' % self.stderr
     
-def timeoutHandler(cmd, seconds, signum, frame):
-    raise TimeoutException(cmd, seconds)
+def runProcess(cmd, args, timeout=None, **popenargs):
+    """Run args to completion and return (process, stdout, stderr).
     
-def call(cmd, timeout = None, printcommand=True):
+    A process still running after timeout seconds is killed from a timer thread, so
+    unlike SIGALRM this works on any thread, and TimeoutException is raised."""
+    p = subprocess.Popen(args, **popenargs)
+    timedout = []
+    timer = None
+    if timeout is not None:
+        def kill():
+            timedout.append(True)
+            try:
+                p.kill()
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        stdoutdata, stderrdata = p.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+            timer.join()
+    metrics.recordProcess(len(stdoutdata or "") + len(stderrdata or ""))
+    if timedout:
+        metrics.recordTimeout()
+        raise TimeoutException(cmd, timeout, stdoutdata)
+    return p, stdoutdata, stderrdata
+    
+def call(cmd, timeout = None, printcommand=True, cwd=None):
     if printcommand:
         print cmd
     args = shlex.split(cmd.encode('utf8'))
-    try:
-        if timeout is not None:
-            handler = functools.partial(timeoutHandler, cmd, timeout)
-            signal.signal(signal.SIGALRM, handler)
-            signal.alarm(timeout)
-        p = subprocess.Popen(args)
-        p.wait()
-        if timeout is not None:
-            signal.alarm(0)
-    except TimeoutException as e:
-        p.kill()
-        print e
-        raise
+    p, stdoutdata, stderrdata = runProcess(cmd, args, timeout, cwd=cwd)
     return p.returncode
     
-def readcall(cmd, timeout = None, printcommand=True, printstdout=False, printstderr=True):
+def readcall(cmd, timeout = None, printcommand=True, printstdout=False, printstderr=True, cwd=None, env=None):
     if printcommand:
         print cmd
     args = shlex.split(cmd.encode('utf8'))
-    try:
-        if timeout is not None:
-            handler = functools.partial(timeoutHandler, cmd, timeout)
-            signal.signal(signal.SIGALRM, handler)
-            signal.alarm(timeout)
-        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdoutdata, stderrdata = p.communicate()
-        if timeout is not None:
-            signal.alarm(0)
-    except TimeoutException as e:
-        p.kill()
-        print e
-        raise
+    p, stdoutdata, stderrdata = runProcess(cmd, args, timeout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, env=env)
     if printstdout:
         print stdoutdata
     if printstderr:
@@ -162,138 +464,1273 @@ def readcall(cmd, timeout = None, printcommand=True, printstdout=False, printstd
     return stdoutdata, stderrdata
     
 
+#
+# SVN access
+#
+
+LogEntry = namedtuple("LogEntry", ["number", "author", "date", "log", "paths"])
+ChangedPath = namedtuple("ChangedPath", ["action", "path", "kind", "copyfrompath", "copyfromrev"])
+
+SvnInfo = namedtuple("SvnInfo", ["url", "root", "revision", "kind"])
+
+def parseXmlDate(text):
+    """Turn an 'svn log --xml' date (2013-04-19T08:13:18.123456Z) into something git understands."""
+    match = re.search(r'^([0-9]+-[0-9]+-[0-9]+)T([0-9]+:[0-9]+:[0-9]+)', text)
+    if not match:
+        raise ValueError("Can't parse date from 'svn log --xml': %s" % text)
+    return "%s %s +0000" % match.groups()
+
+def parseXmlLogEntry(elem):
+    number = int(elem.get('revision'))
+    author = elem.findtext('author')
+    date = elem.findtext('date')
+    log = elem.findtext('msg') or ""
+    paths = []
+    for pathelem in elem.iter('path'):
+        copyfromrev = pathelem.get('copyfrom-rev')
+        if copyfromrev is not None:
+            copyfromrev = int(copyfromrev)
+        paths.append(ChangedPath(   action=pathelem.get('action'),
+                                    path=pathelem.text,
+                                    kind=pathelem.get('kind'),
+                                    copyfrompath=pathelem.get('copyfrom-path'),
+                                    copyfromrev=copyfromrev ))
+    if date:
+        date = parseXmlDate(date)
+    return LogEntry(number=number, author=author, date=date, log=log, paths=paths)
+
+def parseSvnInfo(text):
+    fields = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition(': ')
+        if sep and key not in fields:
+            fields[key] = value
+    if 'URL' not in fields:
+        raise ValueError("No URL found in 'svn info'")
+    revision = fields.get('Revision')
+    return SvnInfo( url=fields['URL'],
+                    root=fields.get('Repository Root'),
+                    revision=int(revision) if revision else None,
+                    kind=fields.get('Node Kind') )
+
+def parseSvnUpdateOutput(text):
+    """(action, path) for every path listed in the output of 'svn co', 'svn switch' or 'svn export'."""
+    changes = []
+    for line in text.splitlines():
+        match = re.search(r'^([ADUCGERB ]{1,4}) +(\S.*)$', line)
+        if match and match.group(1).strip():
+            changes.append((match.group(1).strip(), match.group(2)))
+    return changes
+
+def formatSvnChanges(changes):
+    return "\n".join("%-4s %s" % change for change in changes)
+
+def revisionSpec(revnum):
+    return "HEAD" if revnum is None else "%d" % revnum
+
+def targetSpec(target, peg=None):
+    return target if peg is None else "%s@%d" % (target, peg)
+
+def isUrl(target):
+    return re.search(r'^.+://', target) is not None
+
+def isTranslated(props):
+    """True if svn changes a file with these properties on the way out, by expanding
+    keywords or translating line endings."""
+    return 'svn:keywords' in props or props.get('svn:eol-style', 'LF') not in ('LF', 'native')
+
+class CountingReader(object):
+    """Wraps a file being read, counting how many bytes come out of it, and since
+    when the read in progress has been waiting (None between reads)."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+        self.waiting = None
+
+    def read(self, size=-1):
+        self.waiting = time.time()
+        try:
+            data = self.stream.read(size)
+        finally:
+            self.waiting = None
+        self.count += len(data)
+        return data
+
+class IdleWatchdog(object):
+    """Kills a process once a read from it has waited for more than seconds. A stream
+    has no sensible time limit as a whole, but one that stops moving has hung. Time
+    the reader spends elsewhere doesn't count."""
+    def __init__(self, process, reader, seconds):
+        self.fired = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(process, reader, seconds))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, process, reader, seconds):
+        while not self.stopped.wait(min(seconds, 1.0)):
+            waiting = reader.waiting
+            if waiting is not None and time.time() - waiting > seconds:
+                self.fired = True
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+class SubprocessSvnClient(object):
+    """Runs the svn command line client for every query.
+    
+    Revisions of None mean HEAD for URLs and the working copy's own revision for
+    working copy paths. Working copy paths are relative to cwd. Failures raise a
+    CalledProcessError whose stderr is svn's error message.
+    
+    With a timeout, a command that takes longer than that is killed and started
+    again, up to retries times, before TimeoutException is raised."""
+    def __init__(self, timeout=None, retries=0):
+        self.timeout = timeout
+        self.retries = retries
+
+    def run(self, cmd, cwd=None, workingcopy=None, retrycmd=None):
+        """svn's output for cmd. A working copy a timed out command left locked is
+        cleaned up before the next try, which runs retrycmd if there is one. What
+        every try printed is put together."""
+        output = []
+        for attempt in xrange(self.retries + 1):
+            try:
+                text, errtext = readcall(cmd, timeout=self.timeout, printcommand=False, printstdout=False, printstderr=False, cwd=cwd)
+                return "".join(output) + text
+            except TimeoutException as e:
+                print e
+                if attempt == self.retries:
+                    raise
+                print "Trying again (%d of %d)" % (attempt + 1, self.retries)
+                output.append(e.stdout or "")
+                if workingcopy is not None and os.path.exists(os.path.join(cwd or os.getcwd(), workingcopy, '.svn')):
+                    readcall("svn cleanup %s" % workingcopy, timeout=self.timeout, printcommand=False, printstdout=False, printstderr=False, cwd=cwd)
+                if retrycmd is not None:
+                    cmd = retrycmd
+
+    def log(self, url, startrevnum, endrevnum, limit=None, verbose=False):
+        """Yield a LogEntry for each revision from startrevnum to endrevnum that touched url, as they arrive.
+        A stream that stalls is started again from the revision after the last one yielded."""
+        descending = startrevnum is None or (endrevnum is not None and startrevnum > endrevnum)
+        for attempt in xrange(self.retries + 1):
+            try:
+                for entry in self.streamLog(url, startrevnum, endrevnum, limit, verbose):
+                    yield entry
+                    startrevnum = entry.number - 1 if descending else entry.number + 1
+                    if limit is not None:
+                        limit -= 1
+                return
+            except TimeoutException as e:
+                print e
+                if attempt == self.retries:
+                    raise
+                print "Trying again (%d of %d)" % (attempt + 1, self.retries)
+                if limit == 0 or (endrevnum is not None and startrevnum is not None and
+                                  (startrevnum < endrevnum if descending else startrevnum > endrevnum)):
+                    return
+
+    def streamLog(self, url, startrevnum, endrevnum, limit, verbose):
+        cmd = "svn log --xml -r %s:%s" % (revisionSpec(startrevnum), revisionSpec(endrevnum))
+        if verbose:
+            cmd += " -v"
+        if limit is not None:
+            cmd += " --limit %d" % limit
+        cmd += " %s" % url
+        args = shlex.split(cmd.encode('utf8'))
+        with tempfile.TemporaryFile() as errfile:
+            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=errfile)
+            stdout = CountingReader(p.stdout)
+            watchdog = IdleWatchdog(p, stdout, self.timeout) if self.timeout is not None else None
+            try:
+                root = None
+                try:
+                    for event, elem in ElementTree.iterparse(stdout, events=('start', 'end')):
+                        if event == 'start':
+                            if root is None:
+                                root = elem
+                        elif elem.tag == 'logentry':
+                            yield parseXmlLogEntry(elem)
+                            # Throw away the parsed element, we only keep the LogEntry
+                            root.clear()
+                except ElementTree.ParseError:
+                    # When svn fails there's no XML, or only part of it. Its error says why.
+                    if p.wait() == 0:
+                        raise
+                p.wait()
+                if watchdog is not None and watchdog.fired:
+                    metrics.recordTimeout()
+                    raise TimeoutException(cmd, self.timeout)
+                if p.returncode != 0:
+                    errfile.seek(0)
+                    raise CalledProcessError(p.returncode, cmd, None, errfile.read())
+            finally:
+                if watchdog is not None:
+                    watchdog.stop()
+                # Whoever was reading might have stopped early
+                if p.poll() is None:
+                    try:
+                        p.kill()
+                    except OSError:
+                        pass
+                    p.wait()
+                metrics.recordProcess(stdout.count)
+
+    def info(self, target, rev=None, peg=None, cwd=None):
+        cmd = "svn info"
+        if rev is not None:
+            cmd += " -r %d" % rev
+        return parseSvnInfo(self.run("%s %s" % (cmd, targetSpec(target, peg)), cwd))
+
+    def propget(self, name, target, rev=None, recursive=False, cwd=None):
+        """(path, value) for every node at or under target that has the property."""
+        cmd = "svn propget %s" % name
+        if rev is not None:
+            cmd += " -r %d" % rev
+        if recursive:
+            cmd += " -R"
+        text = self.run("%s %s" % (cmd, target), cwd)
+        if not recursive:
+            return [(target, text)] if text else []
+        # Each property starts with a 'PATH - ' line, and the rest of its lines follow
+        result = []
+        for line in text.splitlines():
+            tokens = line.split()
+            if len(tokens) > 1 and tokens[1] == "-":
+                result.append((tokens[0], [line.split(" - ", 1)[1]]))
+            elif result:
+                result[-1][1].append(line)
+        return [(path, "\n".join(lines)) for path, lines in result]
+
+    def revprops(self, url, rev):
+        """{name: value} of the revision properties of rev."""
+        root = ElementTree.fromstring(self.run("svn proplist --revprop -v --xml -r %d %s" % (rev, url)))
+        return dict((prop.get('name'), prop.text or "") for prop in root.iter('property'))
+
+    def list(self, url, rev=None, peg=None):
+        """Names of the entries in a directory, with a trailing / on directories."""
+        cmd = "svn list"
+        if rev is not None:
+            cmd += " -r %d" % rev
+        return self.run("%s %s" % (cmd, targetSpec(url, peg))).splitlines()
+
+    def cat(self, url, rev=None, peg=None):
+        cmd = "svn cat"
+        if rev is not None:
+            cmd += " -r %d" % rev
+        return self.run("%s %s" % (cmd, targetSpec(url, peg)))
+
+    def checkout(self, url, path, rev, peg=None, cwd=None):
+        """Check out url into path without externals. Returns the (action, path) changes."""
+        text = self.run("svn co --ignore-externals -r %d %s %s" % (rev, targetSpec(url, peg), path), cwd, workingcopy=path)
+        return parseSvnUpdateOutput(text)
+
+    def switch(self, url, path, rev, peg=None, cwd=None, ignoreancestry=False, accepttheirs=False):
+        cmd = "svn switch --ignore-externals"
+        if ignoreancestry:
+            cmd += " --ignore-ancestry"
+        if accepttheirs:
+            cmd += " --accept theirs-full"
+        text = self.run("%s -r %d %s %s" % (cmd, rev, targetSpec(url, peg), path), cwd, workingcopy=path)
+        return parseSvnUpdateOutput(text)
+
+    def export(self, url, path, rev, peg=None, cwd=None, force=False, ignoreexternals=False):
+        options = " --ignore-externals" if ignoreexternals else ""
+        args = "-r %d %s %s" % (rev, targetSpec(url, peg), path)
+        # Trying again has to write over what the timed out export left behind
+        text = self.run("svn export%s%s %s" % (" --force" if force else "", options, args), cwd,
+                        retrycmd="svn export --force%s %s" % (options, args))
+        return parseSvnUpdateOutput(text)
+
+    def fetchFiles(self, urls, rev, batchsize=100):
+        """{url: (content, props)} for files as they are in the repository at rev.
+        
+        A batch takes three svn processes however many files are in it: the
+        properties and sizes come first, so that one 'svn cat' of the whole
+        batch can be cut back up into files. Keywords are expanded and line
+        endings translated, the same as 'svn export' and a working copy do."""
+        # svn prints the targets back canonicalized, which doesn't escape what urllib.quote does
+        def key(target):
+            return urllib.unquote(re.sub(r'@[0-9]+$', '', target))
+        files = {}
+        for i in xrange(0, len(urls), batchsize):
+            batch = urls[i:i + batchsize]
+            targets = " ".join(targetSpec(url, rev) for url in batch)
+            props = {}
+            root = ElementTree.fromstring(self.run("svn proplist -v --xml %s" % targets))
+            for target in root.iter('target'):
+                props[key(target.get('path'))] = dict((prop.get('name'), prop.text or "") for prop in target.iter('property'))
+            sizes = {}
+            root = ElementTree.fromstring(self.run("svn list --xml %s" % targets))
+            for listing in root.iter('list'):
+                entries = listing.findall('entry')
+                if len(entries) == 1 and entries[0].get('kind') == 'file':
+                    sizes[key(listing.get('path'))] = int(entries[0].findtext('size'))
+            # Expanding keywords or translating line endings changes the sizes, those files go one by one,
+            # and so does anything svn didn't answer for the way we expected
+            plain = [url for url in batch if key(url) in sizes and not isTranslated(props.get(key(url), {}))]
+            if plain:
+                text = self.run("svn cat %s" % " ".join(targetSpec(url, rev) for url in plain))
+                if len(text) == sum(sizes[key(url)] for url in plain):
+                    pos = 0
+                    for url in plain:
+                        size = sizes[key(url)]
+                        files[url] = (text[pos:pos + size], props.get(key(url), {}))
+                        pos += size
+            for url in batch:
+                if url not in files:
+                    files[url] = (self.run("svn cat %s" % targetSpec(url, rev)), props.get(key(url), {}))
+        return files
+
+class SessionSvnClient(object):
+    """The same queries as SubprocessSvnClient, through Subversion's Python bindings.
+    
+    Every svn process reopens the repository and rereads its config, which is most of
+    the cost of a query against a local file:// mirror. This keeps one RA session per
+    repository open for the whole conversion instead. The bindings aren't thread safe,
+    so calls from the --jobs threads take turns."""
+    def __init__(self):
+        svn.core.svn_config_ensure(None)
+        self.config = svn.core.svn_config_get_config(None)
+        self.context = svn.client.create_context()
+        self.context.config = self.config
+        self.context.auth_baton = svn.core.svn_auth_open([  svn.client.get_simple_provider(),
+                                                            svn.client.get_username_provider(),
+                                                            svn.client.get_ssl_server_trust_file_provider() ])
+        self.context.notify_func2 = self.notify
+        self.notifyActions = {  svn.wc.svn_wc_notify_update_add: 'A',
+                                svn.wc.svn_wc_notify_update_delete: 'D',
+                                svn.wc.svn_wc_notify_update_update: 'U',
+                                svn.wc.svn_wc_notify_update_replace: 'R',
+                                svn.wc.svn_wc_notify_exists: 'E',
+                                svn.wc.svn_wc_notify_tree_conflict: 'C' }
+        self.nodeKinds = {svn.core.svn_node_dir: 'directory', svn.core.svn_node_file: 'file'}
+        # Repository root URL -> RA session opened there
+        self.sessions = {}
+        self.changes = None
+        self.lock = threading.RLock()
+
+    def call(self, cmd, func, *args):
+        """Call into the bindings, turning their errors into the ones svn would give us."""
+        with self.lock:
+            try:
+                return func(*args)
+            except svn.core.SubversionException as e:
+                messages = []
+                while e is not None:
+                    messages.append("svn: E%06d: %s" % (getattr(e, 'apr_err', None) or 0, e.args[0]))
+                    e = getattr(e, 'child', None)
+                raise CalledProcessError(1, cmd, None, "\n".join(messages))
+
+    def fail(self, cmd, message):
+        raise CalledProcessError(1, cmd, None, "svn: %s" % message)
+
+    def open(self, url):
+        """The session for the repository url is in, its root URL, and url's path in it."""
+        url = url.rstrip('/')
+        with self.lock:
+            for root, session in self.sessions.iteritems():
+                if url == root or url.startswith(root + '/'):
+                    break
+            else:
+                callbacks = svn.ra.Callbacks()
+                callbacks.auth_baton = self.context.auth_baton
+                session = self.call("svn info %s" % url, svn.ra.open2, url, callbacks, self.config)
+                root = svn.ra.get_repos_root2(session)
+                svn.ra.reparent(session, root)
+                self.sessions[root] = session
+        return session, root, urllib.unquote(url[len(root):]).strip('/')
+
+    def revision(self, revnum, default=None):
+        revision = svn.core.svn_opt_revision_t()
+        if revnum is not None:
+            revision.kind = svn.core.svn_opt_revision_number
+            revision.value.number = revnum
+        elif default is not None:
+            revision.kind = default
+        else:
+            revision.kind = svn.core.svn_opt_revision_unspecified
+        return revision
+
+    def notify(self, notify, pool):
+        action = self.notifyActions.get(notify.action)
+        if action is not None and self.changes is not None:
+            self.changes.append((action, notify.path))
+
+    def trackChanges(self, cwd, cmd, func, *args):
+        """Run a working copy operation and return what it told us it changed."""
+        with self.lock:
+            self.changes = []
+            try:
+                self.call(cmd, func, *args)
+                changes = self.changes
+            finally:
+                self.changes = None
+        cwd = cwd or os.getcwd()
+        return [(action, os.path.relpath(path, cwd)) for action, path in changes]
+
+    def log(self, url, startrevnum, endrevnum, limit=None, verbose=False):
+        entries = []
+        def receiver(entry, pool):
+            revprops = entry.revprops or {}
+            paths = []
+            if entry.changed_paths2:
+                for path, changed in sorted(entry.changed_paths2.iteritems()):
+                    copyfromrev = changed.copyfrom_rev if changed.copyfrom_path else None
+                    paths.append(ChangedPath(   action=changed.action,
+                                                path=path,
+                                                kind={svn.core.svn_node_dir: 'dir', svn.core.svn_node_file: 'file'}.get(changed.node_kind, ''),
+                                                copyfrompath=changed.copyfrom_path,
+                                                copyfromrev=copyfromrev ))
+            date = revprops.get('svn:date')
+            entries.append(LogEntry(number=entry.revision,
+                                    author=revprops.get('svn:author'),
+                                    date=parseXmlDate(date) if date else None,
+                                    log=revprops.get('svn:log') or "",
+                                    paths=paths))
+        cmd = "svn log -r %s:%s %s" % (revisionSpec(startrevnum), revisionSpec(endrevnum), url)
+        with self.lock:
+            session, root, path = self.open(url)
+            latest = svn.ra.get_latest_revnum(session)
+            self.call(cmd, svn.ra.get_log2, session, [path],
+                      latest if startrevnum is None else startrevnum,
+                      latest if endrevnum is None else endrevnum,
+                      limit or 0, verbose, False, False, ['svn:author', 'svn:date', 'svn:log'], receiver)
+        return iter(entries)
+
+    def info(self, target, rev=None, peg=None, cwd=None):
+        cmd = "svn info %s" % targetSpec(target, peg)
+        if not isUrl(target):
+            infos = []
+            def receiver(path, info, pool):
+                infos.append(SvnInfo(url=info.URL, root=info.repos_root_URL, revision=info.rev, kind=self.nodeKinds.get(info.kind)))
+            path = os.path.abspath(os.path.join(cwd or os.getcwd(), target))
+            self.call(cmd, svn.client.info2, path, self.revision(peg), self.revision(rev), receiver,
+                      svn.core.svn_depth_empty, None, self.context)
+            return infos[0]
+        with self.lock:
+            session, root, path = self.open(target)
+            if peg is None:
+                peg = svn.ra.get_latest_revnum(session)
+            if self.call(cmd, svn.ra.check_path, session, path, peg) == svn.core.svn_node_none:
+                self.fail(cmd, "URL '%s' non-existent in revision %d" % (target, peg))
+            if rev is None:
+                rev = peg
+            if rev != peg:
+                # Follow the object back through its copies, like an operative revision does
+                locations = self.call(cmd, svn.ra.get_locations, session, path, peg, [rev])
+                if rev not in locations:
+                    self.fail(cmd, "Unable to find repository location for '%s' in revision %d" % (target, rev))
+                path = locations[rev].strip('/')
+            kind = self.call(cmd, svn.ra.check_path, session, path, rev)
+        url = root + '/' + urllib.quote(path) if path else root
+        return SvnInfo(url=url, root=root, revision=rev, kind=self.nodeKinds.get(kind))
+
+    def propget(self, name, target, rev=None, recursive=False, cwd=None):
+        cwd = cwd or os.getcwd()
+        peg = None
+        if isUrl(target):
+            path = target
+            match = re.search(r'^(.*)@([0-9]+)$', target)
+            if match:
+                path, peg = match.group(1), int(match.group(2))
+        else:
+            path = os.path.abspath(os.path.join(cwd, target))
+        props = self.call("svn propget %s %s" % (name, target), svn.client.propget2, name, path,
+                          self.revision(peg), self.revision(rev), recursive, self.context)
+        # Working copy paths come back absolute, or as URLs when they were read from the repository
+        return sorted((key if isUrl(key) else os.path.relpath(key, cwd), value) for key, value in props.iteritems())
+
+    def revprops(self, url, rev):
+        with self.lock:
+            session, root, path = self.open(url)
+            return dict(self.call("svn proplist --revprop -r %d %s" % (rev, url), svn.ra.rev_proplist, session, rev))
+
+    def list(self, url, rev=None, peg=None):
+        info = self.info(url, rev, peg)
+        with self.lock:
+            session, root, path = self.open(info.url)
+            dirents, fetchedrev, props = self.call("svn list %s" % url, svn.ra.get_dir2, session, path, info.revision, svn.core.SVN_DIRENT_KIND)
+        return sorted(name + '/' if dirent.kind == svn.core.svn_node_dir else name for name, dirent in dirents.iteritems())
+
+    def cat(self, url, rev=None, peg=None):
+        info = self.info(url, rev, peg)
+        stream = cStringIO.StringIO()
+        with self.lock:
+            session, root, path = self.open(info.url)
+            self.call("svn cat %s" % url, svn.ra.get_file, session, path, info.revision, stream)
+        return stream.getvalue()
+
+    def checkout(self, url, path, rev, peg=None, cwd=None):
+        path = os.path.abspath(os.path.join(cwd or os.getcwd(), path))
+        return self.trackChanges(cwd, "svn co %s" % targetSpec(url, peg), svn.client.checkout3, url, path,
+                                 self.revision(peg, svn.core.svn_opt_revision_head), self.revision(rev),
+                                 svn.core.svn_depth_infinity, True, False, self.context)
+
+    def switch(self, url, path, rev, peg=None, cwd=None, ignoreancestry=False, accepttheirs=False):
+        path = os.path.abspath(os.path.join(cwd or os.getcwd(), path))
+        cmd = "svn switch %s" % targetSpec(url, peg)
+        changes = self.trackChanges(cwd, cmd, svn.client.switch3, path, url,
+                                    self.revision(peg, svn.core.svn_opt_revision_head), self.revision(rev),
+                                    svn.core.svn_depth_infinity, False, True, False, ignoreancestry, self.context)
+        if accepttheirs:
+            self.call(cmd, svn.client.resolve, path, svn.core.svn_depth_infinity, svn.wc.svn_wc_conflict_choose_theirs_full, self.context)
+        return changes
+
+    def export(self, url, path, rev, peg=None, cwd=None, force=False, ignoreexternals=False):
+        path = os.path.abspath(os.path.join(cwd or os.getcwd(), path))
+        return self.trackChanges(cwd, "svn export %s" % targetSpec(url, peg), svn.client.export4, url, path,
+                                 self.revision(peg, svn.core.svn_opt_revision_head), self.revision(rev),
+                                 force, ignoreexternals, svn.core.svn_depth_infinity, None, self.context)
+
+    def fetchFiles(self, urls, rev):
+        files = {}
+        for url in urls:
+            stream = cStringIO.StringIO()
+            cmd = "svn cat %s" % targetSpec(url, rev)
+            with self.lock:
+                session, root, path = self.open(url)
+                fetchedrev, props = self.call(cmd, svn.ra.get_file, session, path, rev, stream)
+                props = dict((key, value) for key, value in props.iteritems() if not key.startswith('svn:entry:'))
+                if isTranslated(props):
+                    # The session gives us the file as it's stored, the client expands it like svn cat
+                    stream = cStringIO.StringIO()
+                    self.call(cmd, svn.client.cat2, stream, url, self.revision(rev), self.revision(rev), self.context)
+            files[url] = (stream.getvalue(), props)
+        return files
+
+svnBackends = {'subprocess': SubprocessSvnClient, 'session': SessionSvnClient}
+
 #
 # History Queries
 #
 
 Revision = namedtuple("Revision", ["number", "user", "date", "log"])
 
-def parseLogEntry(intext):
-    text = intext.splitlines()
-
-    # stupid dividers...
-    while text[-1][0:8] == "--------" or not text[-1]:
-        del text[-1]
-    while text[0][0:8] == "--------" or not text[0]:
-        del text[0]
-    # Parse first line, matches something like the following:
-    # r1234 | zbernal@vitalconnect.com | 2013-04-19 01:13:18 -0700 (Fri, 19 Apr 2013) | 3 lines
-    match = re.search(r'^r([0-9]+) \| (.+) \| (.+) \(.+\).*', text[0])
-    if match:
-        number = int(match.groups()[0])
-        svnuser = match.groups()[1]
-        date = match.groups()[2]
-        log = '\n'.join(text[1:])
-        if svnuser not in userLookup:
-            raise ValueError("No git user found for %s at line:\n%s" % (svnuser, text[0]))
-        gituser = userLookup[svnuser]
-        return Revision(number=number, user=gituser, date=date, log=log)
-    else:
-        raise RuntimeError("Not a valid log from 'svn log', cannot parse:\n%s" % text[0])
+def logEntryToRevision(entry):
+    if entry.author not in userLookup:
+        raise ValueError("No git user found for %s at revision %d" % (entry.author, entry.number))
+    return Revision(number=entry.number, user=userLookup[entry.author], date=entry.date, log=entry.log)
+
+def getLogEntry(url, startrevnum, endrevnum):
+    """The first log entry for url going from startrevnum to endrevnum (None is HEAD)."""
+    entries = list(svnClient.log(url, startrevnum, endrevnum, limit=1))
+    if not entries:
+        raise ValueError("No log entries for %s from %s to %s" % (url, revisionSpec(startrevnum), revisionSpec(endrevnum)))
+    return entries[0]
 
 def getFirstRevision(repo):
-    text, errtext = readcall("svn log -r0:HEAD --limit 1 %s" % repo, printcommand=False, printstdout=False, printstderr=False)
-    revision = parseLogEntry(text)
-    return revision
+    return logEntryToRevision(getLogEntry(repo, 0, None))
 
 def getLastRevision(repo):
-    text, errtext = readcall("svn log --limit 1 %s" % repo, printcommand=False, printstdout=False, printstderr=False)
-    revision = parseLogEntry(text)
-    return revision
+    return logEntryToRevision(getLogEntry(repo, None, 0))
+
+def getYoungestRevnum(url):
+    """The newest revision of url's repository that's complete. svnsync commits a
+    revision before it copies the author and date over, and marks the one it's
+    still busy with in revision 0's svn:sync-currently-copying."""
+    youngest = svnClient.info(url).revision
+    copying = svnClient.revprops(url, 0).get('svn:sync-currently-copying')
+    if copying and int(copying) <= youngest:
+        youngest = int(copying) - 1
+    return youngest
+
+def formatLogEntry(entry):
+    """Print a LogEntry roughly the way plain 'svn log' would."""
+    lines = entry.log.splitlines()
+    return "%s\nr%d | %s | %s | %d line%s\n\n%s\n" % ("-" * 72, entry.number, entry.author, entry.date,
+                                                     len(lines), "" if len(lines) == 1 else "s", entry.log)
 
 def getRevision(rev):
-    text, errtext = readcall("svn log -r %d --limit 1 %s" % (rev, rootrepo), printcommand=False, printstdout=False, printstderr=False)
-    revision = parseLogEntry(text)
-    return revision
+    if rev in revisionIndex:
+        return revisionIndex.getRevision(rev)
+    return logEntryToRevision(getLogEntry(rootrepo, rev, rev))
+
+#
+# Revision metadata index
+#
+
+class RevisionIndex(object):
+    """Author, date, message and changed paths for a range of revisions.
+    
+    Built from a single streamed 'svn log --xml -v' so that the replay loop
+    doesn't have to spawn svn for every revision it looks at."""
+    def __init__(self):
+        self.entries = {}
+        # (first, last) ranges where every revision of the whole repository is indexed
+        self.spans = []
+
+    def __contains__(self, revnum):
+        return revnum in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, url, firstrevnum, lastrevnum):
+        """Index every log entry with changed paths for url as it arrives."""
+        for entry in svnClient.log(url, firstrevnum, lastrevnum, verbose=True):
+            self.entries[entry.number] = entry
+        if url.rstrip('/') == reposroot.rstrip('/'):
+            self.spans.append((min(firstrevnum, lastrevnum), max(firstrevnum, lastrevnum)))
+        return self
+
+    def loadDump(self, stream):
+        """Index every revision of a whole dump stream, the same as load does from the log."""
+        actions = {'add': 'A', 'delete': 'D', 'change': 'M', 'replace': 'R'}
+        entry = None
+        for record in svndump.readRecords(stream, skiptext=True):
+            headers = record.headers
+            if 'Revision-number' in headers:
+                entry = None
+                if int(headers['Revision-number']) == 0:
+                    # Only the log shows up as changes, and revision 0 never has any
+                    continue
+                revprops = record.props or {}
+                date = revprops.get('svn:date')
+                entry = LogEntry(   number=int(headers['Revision-number']),
+                                    author=revprops.get('svn:author'),
+                                    date=parseXmlDate(date) if date else None,
+                                    log=revprops.get('svn:log', ""),
+                                    paths=[] )
+                self.entries[entry.number] = entry
+            elif 'Node-path' in headers and entry is not None:
+                copyfrompath = headers.get('Node-copyfrom-path')
+                if copyfrompath is not None:
+                    copyfrompath = '/' + copyfrompath.strip('/')
+                copyfromrev = headers.get('Node-copyfrom-rev')
+                if copyfromrev is not None:
+                    copyfromrev = int(copyfromrev)
+                entry.paths.append(ChangedPath( action=actions[headers['Node-action']],
+                                                path='/' + headers['Node-path'].strip('/'),
+                                                kind=headers.get('Node-kind', ''),
+                                                copyfrompath=copyfrompath,
+                                                copyfromrev=copyfromrev ))
+        if self.entries:
+            self.spans.append((min(self.entries), max(self.entries)))
+        return self
+
+    def covers(self, revnum):
+        """True if the index knows everything that happened anywhere in revnum."""
+        return any(first <= revnum <= last for first, last in self.spans)
+
+    def getEntry(self, revnum):
+        return self.entries[revnum]
+
+    def getChangedPaths(self, revnum):
+        if revnum in self.entries:
+            return self.entries[revnum].paths
+        return []
+
+    def getRevision(self, revnum):
+        return logEntryToRevision(self.entries[revnum])
+
+revisionIndex = RevisionIndex()
+
+class PropertyChangeIndex(object):
+    """Which directories had svn:externals changed, for every indexed revision.
+    
+    From the log this can only be a guess: a directory shows up as modified when any
+    of its properties changed, so every one of them is recorded. A dump has the
+    properties themselves, so it tells exactly."""
+    def __init__(self):
+        self.changes = {}
+    
+    def __contains__(self, revnum):
+        return revnum in self.changes
+    
+    def loadLog(self, index, revnums=None):
+        """Guess from the log, for revnums or every indexed revision."""
+        if revnums is None:
+            revnums = index.entries.keys()
+        for revnum in revnums:
+            if revnum in index:
+                self.changes[revnum] = set(changed.path.rstrip('/') or '/' for changed in index.getChangedPaths(revnum) if changed.action == 'M' and changed.kind != 'file')
+        return self
+    
+    def loadDump(self, stream):
+        """Compare svn:externals node by node through a whole dump stream."""
+        # The svn:externals value of every directory, where it's known, and the same
+        # directories sorted, so that everything under one of them is a single slice.
+        values = {}
+        known = []
+        def remember(path, value):
+            if path not in values:
+                bisect.insort(known, path)
+            values[path] = value
+        def forget(path):
+            if path == '/':
+                start, end = 0, len(known)
+            else:
+                # '0' sorts right after '/'
+                start, end = bisect.bisect_left(known, path + '/'), bisect.bisect_left(known, path + '0')
+            for subpath in known[start:end]:
+                del values[subpath]
+            del known[start:end]
+            if path in values:
+                del values[path]
+                del known[bisect.bisect_left(known, path)]
+        revnum = None
+        for record in svndump.readRecords(stream, skiptext=True):
+            headers = record.headers
+            if 'Revision-number' in headers:
+                revnum = int(headers['Revision-number'])
+                self.changes[revnum] = set()
+                continue
+            if 'Node-path' not in headers or revnum is None:
+                continue
+            path = '/' + headers['Node-path'].strip('/')
+            action = headers['Node-action']
+            if action in ('delete', 'replace') or 'Node-copyfrom-path' in headers:
+                # Forget the whole subtree. Copies bring along values we didn't keep.
+                forget(path)
+            if action == 'delete' or headers.get('Node-kind', 'dir') != 'dir':
+                continue
+            if action in ('add', 'replace') and 'Node-copyfrom-path' not in headers:
+                remember(path, None)
+            if record.props is None:
+                continue
+            if headers.get('Prop-delta') == 'true':
+                changed = 'svn:externals' in record.props or 'svn:externals' in record.propdeletes
+            else:
+                changed = path not in values or values[path] != record.props.get('svn:externals')
+            if changed:
+                self.changes[revnum].add(path)
+            if headers.get('Prop-delta') == 'true' and path in values:
+                if 'svn:externals' in record.propdeletes:
+                    remember(path, None)
+                if 'svn:externals' in record.props:
+                    remember(path, record.props['svn:externals'])
+            elif headers.get('Prop-delta') != 'true':
+                remember(path, record.props.get('svn:externals'))
+        return self
+    
+    def didExternalsChange(self, revnum, path):
+        """True if svn:externals on path might have changed in revnum. Revisions that
+        weren't indexed might have changed anything."""
+        changes = self.changes.get(revnum)
+        return changes is None or (path.rstrip('/') or '/') in changes
+
+propertyChanges = PropertyChangeIndex()
+
+def loadPropertyChanges(dumpfile=None):
+    """Index svn:externals changes from dumpfile (- for stdin) if there is one,
+    otherwise from the revision index."""
+    if dumpfile == '-':
+        propertyChanges.loadDump(sys.stdin)
+    elif dumpfile:
+        with open(dumpfile, 'rb') as dumpstream:
+            propertyChanges.loadDump(dumpstream)
+    else:
+        propertyChanges.loadLog(revisionIndex)
+
+#
+# Revision planning
+#
+
+def isPathUnder(path, parent):
+    """True if path is parent or somewhere inside it. Paths are repository paths like /trunk/src."""
+    parent = parent.rstrip('/')
+    return path == parent or path.startswith(parent + '/') or not parent
+
+def getLocationHistory(index, path, firstrevnum, lastrevnum):
+    """Follow the copy history of path@lastrevnum back to firstrevnum.
+    
+    Returns a list of (startrev, endrev, path) segments, newest first. Revisions that
+    fall between segments aren't part of this object's history at all."""
+    locations = []
+    endrevnum = lastrevnum
+    revnum = lastrevnum
+    while revnum >= firstrevnum:
+        # The deepest add or replace above our path is the one that created it
+        created = None
+        for changed in index.getChangedPaths(revnum):
+            if changed.action in ('A', 'R') and isPathUnder(path, changed.path):
+                if created is None or len(changed.path) > len(created.path):
+                    created = changed
+        if created is None:
+            revnum -= 1
+            continue
+        locations.append((revnum, endrevnum, path))
+        if created.copyfrompath is None:
+            # Created from nothing, there's no more history to follow.
+            return locations
+        path = created.copyfrompath + path[len(created.path.rstrip('/')):]
+        endrevnum = created.copyfromrev
+        revnum = created.copyfromrev
+    if endrevnum >= firstrevnum:
+        locations.append((firstrevnum, endrevnum, path))
+    return locations
+
+def getCopySources(index, paths):
+    """paths, and every path anything in them was copied from, all the way back
+    through the index. Together they hold the whole history of paths."""
+    sources = set(paths)
+    for revnum in sorted(index.entries, reverse=True):
+        for changed in index.getChangedPaths(revnum):
+            if changed.copyfrompath is None:
+                continue
+            for path in list(sources):
+                if isPathUnder(changed.path, path):
+                    sources.add(changed.copyfrompath)
+                elif isPathUnder(path, changed.path):
+                    sources.add(changed.copyfrompath.rstrip('/') + path[len(changed.path.rstrip('/')):])
+    return sources
+
+notPresentMessages = ["Unable to find repository location", "non-existent in revision"]
+
+def pathExistsAt(index, path, revnum):
+    """Whether anything lives at a repository path in revnum. Follows the adds,
+    copies and deletes in the index back to where path came from, and only asks
+    svn if that's further back than the index goes."""
+    while path.strip('/'):
+        if not index.covers(revnum):
+            return svnPathExistsAt(path, revnum)
+        changes = [changed for changed in index.getChangedPaths(revnum) if changed.action in ('A', 'R', 'D') and isPathUnder(path, changed.path)]
+        if not changes:
+            revnum -= 1
+            continue
+        # The deepest change wins
+        changed = max(changes, key=lambda changed: len(changed.path.rstrip('/')))
+        if changed.action == 'D':
+            return False
+        if changed.path.rstrip('/') == path.rstrip('/'):
+            return True
+        if changed.copyfrompath is None:
+            # A new parent directory starts out empty
+            return False
+        path = changed.copyfrompath + path[len(changed.path.rstrip('/')):]
+        revnum = changed.copyfromrev
+    return True
+
+def svnPathExistsAt(path, revnum):
+    """Ask svn whether anything lives at a repository path in revnum."""
+    try:
+        getUrlForRepoAtRevision(reposroot + urllib.quote(path), peg=revnum)
+    except CalledProcessError as e:
+        if any(e.stderr.find(message) != -1 for message in notPresentMessages):
+            return False
+        raise
+    return True
+
+class AncestryHistory(object):
+    """Where an object has lived over time, worked out from the copy records in the
+    revision index instead of asking svn about every revision.
+    
+    locations answers 'svn info -r REV URL': where URL@HEAD was at REV, following
+    its copies back. pegSpans answers 'svn info URL@REV': whether anything was at
+    that exact path at REV. svn is only asked when a parent directory was copied in
+    and the log doesn't go back far enough to tell whether our path came along with it."""
+    def __init__(self, index, path, firstrevnum, lastrevnum):
+        self.index = index
+        self.path = path
+        self.firstrevnum = firstrevnum
+        self.lastrevnum = lastrevnum
+        self.locations = getLocationHistory(index, path, firstrevnum, lastrevnum)
+        self.pegSpans = None
+
+    def locationAt(self, revnum):
+        for startrevnum, endrevnum, path in self.locations:
+            if startrevnum <= revnum <= endrevnum:
+                return path
+        return None
+
+    def getPegSpans(self):
+        """(startrev, endrev) spans during which something exists at our exact path."""
+        if self.pegSpans is not None:
+            return self.pegSpans
+        self.pegSpans = []
+        startrevnum = self.firstrevnum
+        exists = self.firstrevnum > 0 and pathExistsAt(self.index, self.path, self.firstrevnum - 1)
+        for revnum in xrange(self.firstrevnum, self.lastrevnum + 1):
+            changes = [changed for changed in self.index.getChangedPaths(revnum) if isPathUnder(self.path, changed.path)]
+            if not changes:
+                continue
+            nowexists = exists
+            # Work from the top down so that the deepest change wins
+            for changed in sorted(changes, key=lambda changed: len(changed.path)):
+                if changed.action == 'D':
+                    nowexists = False
+                elif changed.action in ('A', 'R'):
+                    if changed.path.rstrip('/') == self.path.rstrip('/'):
+                        nowexists = True
+                    elif changed.copyfrompath is None:
+                        nowexists = False
+                    else:
+                        nowexists = pathExistsAt(self.index, self.path, revnum)
+            if nowexists and not exists:
+                startrevnum = revnum
+            elif exists and not nowexists:
+                self.pegSpans.append((startrevnum, revnum - 1))
+            exists = nowexists
+        if exists:
+            self.pegSpans.append((startrevnum, self.lastrevnum))
+        return self.pegSpans
+
+    def transitions(self):
+        """Yield (revnum, [(kind, path or None), ...]) for every revision where the
+        'r' (operative revision) or 'p' (peg revision) answer changes."""
+        revValues = [(startrevnum, endrevnum, path) for startrevnum, endrevnum, path in self.locations]
+        pegValues = [(startrevnum, endrevnum, self.path) for startrevnum, endrevnum in self.getPegSpans()]
+        breakpoints = set([self.firstrevnum])
+        for startrevnum, endrevnum, path in revValues + pegValues:
+            breakpoints.add(startrevnum)
+            breakpoints.add(endrevnum + 1)
+        previous = {'r': "", 'p': ""}
+        for revnum in sorted(breakpoints):
+            if revnum > self.lastrevnum:
+                break
+            events = []
+            for kind, values in (('r', revValues), ('p', pegValues)):
+                value = None
+                for startrevnum, endrevnum, path in values:
+                    if startrevnum <= revnum <= endrevnum:
+                        value = path
+                if value != previous[kind]:
+                    events.append((kind, value))
+                    previous[kind] = value
+            if events:
+                yield revnum, events
+
+class RevisionPlan(object):
+    """Decides which revisions touch the target repo, its old locations, or its externals.
+    
+    Everything else can be skipped without spawning svn or git at all."""
+    def __init__(self, index, path, firstrevnum, lastrevnum):
+        self.index = index
+        self.ancestry = AncestryHistory(index, path, firstrevnum, lastrevnum)
+        self.locations = self.ancestry.locations
+        self.externpaths = set()
+
+    def locationAt(self, revnum):
+        return self.ancestry.locationAt(revnum)
+
+    def setExterns(self, externs):
+        """Watch the targets of externs that float with the top-level revision."""
+        self.externpaths = set()
+        for ex in externs:
+            if not ex.pinned:
+                path = urlToRepositoryPath(ex.url)
+                if path is not None:
+                    self.externpaths.add(path)
+
+    def touches(self, changed, path):
+        if isPathUnder(changed.path, path):
+            return True
+        # Moving or deleting a parent directory affects us too
+        return changed.action != 'M' and isPathUnder(path, changed.path)
+
+    def touchesProject(self, revnum):
+        """True if revnum changed the project itself, leaving externs aside."""
+        if revnum not in self.index:
+            return True
+        location = self.locationAt(revnum)
+        if location is None:
+            return False
+        return any(self.touches(changed, location) for changed in self.index.getChangedPaths(revnum))
+
+    def isRelevant(self, revnum):
+        if revnum not in self.index:
+            return True
+        watched = list(self.externpaths)
+        location = self.locationAt(revnum)
+        if location is not None:
+            watched.append(location)
+        for changed in self.index.getChangedPaths(revnum):
+            for path in watched:
+                if self.touches(changed, path):
+                    return True
+        return False
+
+    def select(self, revnumbers, replayfirst=True):
+        """Yield the revisions worth replaying. Unless the working copy and extern
+        set are already known, the first one is always replayed to find out."""
+        first = replayfirst
+        for revnum in revnumbers:
+            if first or self.isRelevant(revnum):
+                first = False
+                yield revnum
 
 #
 # Info queries
 # 
 
+class SvnInfoCache(object):
+    """Remembers 'svn info' answers for a (url, rev, pegrev), which never change.
+    
+    Recently used answers are kept in memory, and everything is also written to
+    a shelf under .git/info so a resumed conversion doesn't have to ask again.
+    "Doesn't exist at this revision" errors are remembered too."""
+    cachederrors = ["non-existent in revision", "Unable to find repository location"]
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.memory = OrderedDict()
+        self.store = None
+        self.lock = threading.RLock()
+
+    def open(self, filename):
+        self.store = shelve.open(filename, protocol=2)
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def lookup(self, key, fetch):
+        key = repr(key)
+        with self.lock:
+            value = self.memory.pop(key, None)
+            if value is None and self.store is not None and key in self.store:
+                value = self.store[key]
+        if value is None:
+            try:
+                value = (None, fetch())
+            except CalledProcessError as e:
+                if not any(e.stderr.find(message) != -1 for message in self.cachederrors):
+                    raise
+                value = ((e.returncode, e.cmd, e.stderr), None)
+            with self.lock:
+                if self.store is not None:
+                    self.store[key] = value
+        with self.lock:
+            self.memory[key] = value
+            while len(self.memory) > self.maxsize:
+                self.memory.popitem(last=False)
+        error, result = value
+        if error is not None:
+            returncode, cmd, stderr = error
+            raise CalledProcessError(returncode, cmd, None, stderr)
+        return result
+
+svnInfoCache = SvnInfoCache()
+
 
-def getRevisionInCwd():
-    text, errtext = readcall("svn info", printcommand=False, printstdout=False, printstderr=False)
-    text = text.splitlines()
-    for line in text:
-        match = re.search(r'^Revision: (.*)$', line)
-        if match:
-            return int(match.groups()[0])
-    raise ValueError("No Revision found in 'svn info'")
-
-def getUrlInCwd():
-    text, errtext = readcall("svn info", printcommand=False, printstdout=False, printstderr=False)
-    text = text.splitlines()
-    for line in text:
-        match = re.search(r'^URL: (.*)$', line)
-        if match:
-            return match.groups()[0]
-    raise ValueError("No URL found in 'svn info'")
 
 def getUrlForRepoAtRevision(repo, rev=None, peg=None):
     assert rev != None or peg != None
-    if rev == None:
-        text, errtext = readcall("svn info %s@%d" % (repo, peg), printcommand=False, printstdout=False, printstderr=False)
-    elif peg == None:
-        text, errtext = readcall("svn info -r %d %s" % (rev, repo), printcommand=False, printstdout=False, printstderr=False)
-    else:
-        text, errtext = readcall("svn info -r %d %s@%d" % (rev, repo, peg), printcommand=False, printstdout=False, printstderr=False)
-    text = text.splitlines()
-    for line in text:
-        match = re.search(r'^URL: (.*)$', line)
-        if match:
-            return match.groups()[0]
-    raise ValueError("No URL found in 'svn info'")
-
+    if peg == None:
+        # Without a peg revision the answer depends on HEAD, so it can't be cached.
+        return fetchUrlForRepoAtRevision(repo, rev, peg)
+    return svnInfoCache.lookup(('url', repo, rev, peg), functools.partial(fetchUrlForRepoAtRevision, repo, rev, peg))
+
+def fetchUrlForRepoAtRevision(repo, rev=None, peg=None):
+    return svnClient.info(repo, rev=rev, peg=peg).url
+
+
+def getRepositoryRoot(url):
+    root = svnClient.info(url).root
+    if root is None:
+        raise ValueError("No Repository Root found in 'svn info'")
+    return root
+
+def urlToRepositoryPath(url):
+    """Turn a URL inside our repository into a path like the ones 'svn log -v' prints."""
+    if not url.startswith(reposroot):
+        return None
+    path = urllib.unquote(url[len(reposroot):])
+    if not path.startswith('/'):
+        path = '/' + path
+    return path
 
 def getNodeKindForUrl(url, rev, pegrev):
-    text, errtext = readcall("svn info -r %d %s@%d" % (rev, url, pegrev), printcommand=False, printstdout=False, printstderr=False)
-    text = text.splitlines()
-    for line in text:
-        match = re.search(r'^Node Kind: (.*)$', line)
-        if match:
-            return match.groups()[0]
-    raise ValueError("No Node Kind found in 'svn info'")
+    return svnInfoCache.lookup(('kind', url, rev, pegrev), functools.partial(fetchNodeKindForUrl, url, rev, pegrev))
+
+def fetchNodeKindForUrl(url, rev, pegrev):
+    kind = svnClient.info(url, rev=rev, peg=pegrev).kind
+    if kind is None:
+        raise ValueError("No Node Kind found in 'svn info'")
+    return kind
 
 def isThisPathDeleted(url, revnum):
-    text, errtext = readcall("svn log -v -r %d %s" % (revnum, rootrepo), printcommand=False, printstdout=False, printstderr=False)
-    text = text.splitlines()
-    for line in text:
-        match = re.search(r'^ *D(.*)', line)
-        if match:
-            delitem = match.groups()[0].strip()
-            if url.find(delitem) != -1:
+    if revnum in revisionIndex:
+        for changed in revisionIndex.getChangedPaths(revnum):
+            if changed.action == 'D' and url.find(changed.path) != -1:
+                return True
+        return False
+    for entry in svnClient.log(rootrepo, revnum, revnum, verbose=True):
+        for changed in entry.paths:
+            if changed.action == 'D' and url.find(changed.path) != -1:
                 return True
     return False
 
 
 #
-# Handling Externs
+# Changed path tracking
 #
 
-Extern = namedtuple("Extern", ["object", "url", "rev", "pegrev", "isdirectory", "broken"])
+class ChangedPaths(object):
+    """The work tree paths svn touched since the last commit, relative to the work tree root.
+    
+    paths is None when we don't know, e.g. after the work tree was wiped, and
+    the whole tree has to be looked at."""
+    def __init__(self):
+        self.root = None
+        self.paths = None
+        self.lock = threading.Lock()
+
+    def setRoot(self, root):
+        self.root = root
+
+    def reset(self):
+        self.paths = set()
+
+    def everything(self):
+        self.paths = None
+
+    def add(self, path, cwd=None):
+        """Record a path relative to cwd, or the current directory."""
+        path = os.path.relpath(os.path.join(cwd or os.getcwd(), path), self.root)
+        with self.lock:
+            if self.paths is not None:
+                self.paths.add(path)
+
+    def addSvnChanges(self, changes, cwd=None):
+        """Record every path an svn checkout, switch or export reported."""
+        for action, path in changes:
+            self.add(path, cwd)
+
+changedPaths = ChangedPaths()
 
-def getExternals(toplevelrevnum):
-    revnum = getRevisionInCwd()
-    text, errtext = readcall("svn propget svn:externals -r %d -R" % (revnum), printcommand=False, printstdout=False, printstderr=False)
-    text = text.splitlines()
+def isSvnMetadataPath(path):
+    return '.svn' in path.split(os.sep)
 
-    currentParentDir = None
-    for line in text:
+#
+# Handling Externs
+#
+
+Extern = namedtuple("Extern", ["object", "url", "rev", "pegrev", "isdirectory", "broken", "pinned"])
+
+class ExternalsIndex(object):
+    """The svn:externals definitions of every tree we fetch externs into (the project
+    and each directory extern), keyed by the directory they're set on.
+    
+    A tree is read with one 'svn propget -R' the first time it's seen. When it moves
+    on to a later revision of the same URL, only the directories that were added, or
+    that the property change index says had svn:externals changed, are read again."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # directory -> (url, rev, pegrev, {parent dir relative to directory: property text})
+        self.entries = {}
+        # The same, read ahead of the replay by prefetch()
+        self.ahead = {}
+    
+    def forget(self, path):
+        with self.lock:
+            for directory in self.entries.keys():
+                if directory == path or directory.startswith(path + os.sep):
+                    del self.entries[directory]
+    
+    def lookup(self, directory, url, rev, pegrev):
+        """Returns (parent dir, property text) for every definition in the tree that
+        directory holds, which is url@pegrev at rev."""
+        return sorted(self.advance(self.entries, directory, url, rev, pegrev).iteritems())
+    
+    def prefetch(self, directory, url, rev):
+        """Read the definitions directory will have at rev ahead of time, without
+        disturbing what lookup() knows. Hand them over with seed() when it gets there."""
+        return self.advance(self.ahead, directory, url, rev, rev)
+    
+    def seed(self, directory, url, rev, definitions):
+        with self.lock:
+            self.entries[directory] = (url, rev, rev, definitions)
+    
+    def advance(self, entries, directory, url, rev, pegrev):
+        with self.lock:
+            entry = entries.get(directory)
+        definitions = None
+        if entry is not None:
+            oldurl, oldrev, oldpegrev, olddefinitions = entry
+            if (oldurl, oldrev, oldpegrev) == (url, rev, pegrev):
+                definitions = olddefinitions
+            elif oldurl == url and oldrev == oldpegrev and rev == pegrev and rev > oldrev:
+                definitions = self.refresh(url, oldrev, rev, dict(olddefinitions))
+        if definitions is None:
+            definitions = self.read(url, rev, pegrev, "", True)
+        with self.lock:
+            entries[directory] = (url, rev, pegrev, definitions)
+        return definitions
+    
+    def read(self, url, rev, pegrev, parentdir, recursive):
+        """Read the definitions at (or under) parentdir of url@pegrev from the repository."""
+        target = url + "/" + urllib.quote(parentdir) if parentdir else url
+        definitions = {}
+        base = None
+        for path, text in svnClient.propget("svn:externals", targetSpec(target, pegrev), rev=rev, recursive=recursive):
+            path = urllib.unquote(re.sub(r'@[0-9]+$', '', path))
+            if not isUrl(path):
+                path = target
+            for prefix in (urllib.unquote(url), base):
+                if prefix is not None and (path == prefix or path.startswith(prefix + "/")):
+                    break
+            else:
+                # Operative revision isn't the peg revision, so the paths are somewhere else.
+                base = prefix = urllib.unquote(getUrlForRepoAtRevision(url, rev, pegrev))
+            definitions[path[len(prefix):].strip("/")] = text
+        return definitions
+    
+    def refresh(self, url, oldrev, rev, definitions):
+        """Bring the definitions of url from oldrev up to rev. Returns None if they
+        have to be read from scratch instead."""
+        location = urlToRepositoryPath(url)
+        if location is None:
+            return None
+        location = location.rstrip('/')
+        directories = set()
+        trees = set()
+        for r in xrange(oldrev + 1, rev + 1):
+            if r not in revisionIndex:
+                return None
+            for changed in revisionIndex.getChangedPaths(r):
+                if changed.path.rstrip('/') == location and changed.action == 'M':
+                    if propertyChanges.didExternalsChange(r, changed.path):
+                        directories.add("")
+                    continue
+                if isPathUnder(location, changed.path) and changed.action != 'M':
+                    # The whole tree was moved, replaced or deleted.
+                    return None
+                if not isPathUnder(changed.path, location) or changed.path.rstrip('/') == location:
+                    continue
+                parentdir = changed.path[len(location):].strip('/')
+                if changed.action == 'M':
+                    if changed.kind != 'file' and propertyChanges.didExternalsChange(r, changed.path):
+                        directories.add(parentdir)
+                    continue
+                for known in (definitions, directories, trees):
+                    for key in list(known):
+                        if key == parentdir or key.startswith(parentdir + "/"):
+                            if isinstance(known, dict):
+                                del known[key]
+                            else:
+                                known.discard(key)
+                if changed.action != 'D' and changed.kind != 'file':
+                    trees.add(parentdir)
+        for parentdir in trees:
+            definitions.update(self.read(url, rev, rev, parentdir, True))
+        for parentdir in directories - trees:
+            definitions.pop(parentdir, None)
+            definitions.update(self.read(url, rev, rev, parentdir, False))
+        return definitions
+
+externalsIndex = ExternalsIndex()
+
+def getExternals(toplevelrevnum, cwd, url, rev, pegrev):
+    """Yield the externs defined anywhere in cwd, which holds url@pegrev at rev."""
+    for currentParentDir, text in externalsIndex.lookup(cwd, url, rev, pegrev):
+        for ex in parseExternalsDefinition(toplevelrevnum, currentParentDir, text, cwd):
+            yield ex
+
+def parseExternalsDefinition(toplevelrevnum, currentParentDir, text, cwd=None):
+    """Yield an Extern for every line of an svn:externals property set on currentParentDir."""
+    for line in text.splitlines():
         tokens = line.split()
         if tokens:
             try:
-                # Parse the parent directory
-                if tokens[1] == "-":
-                    currentParentDir = tokens[0]
-                    if re.search(r'^.*://', currentParentDir):
-                        # Great, they gave us a URL when we needed a relative path. Let's remake the relative path.
-                        url = getUrlInCwd()
-                        currentParentDir = currentParentDir.replace(url, "")
-                        if currentParentDir and currentParentDir[0] == '/':
-                            currentParentDir = currentParentDir[1:]
-                    #print "currentParentDir:", currentParentDir
-                    tokens = tokens[2:]
-
                 if len(tokens) > 0: # sometimes we get a deleted extern that leaves this behind
                     # Parse extern line
                     childObject = None
@@ -333,6 +1770,10 @@ def getExternals(toplevelrevnum):
                     for remoterepo in remoterepos:
                         externUrl = externUrl.replace(remoterepo, rootrepo)
                         
+                    pinned = externPegrev != None or externRev != None
+                    # Only an operative rev, which is resolved against the top-level rev below
+                    unpegged = externPegrev == None and externRev != None
+                    
                     # Set the pegrev to the top-level rev. We want to get this extern
                     # as if we were checking it out on the day of this commit.
                     if externPegrev == None:
@@ -345,6 +1786,12 @@ def getExternals(toplevelrevnum):
                     # Get the node kind for this extern, or find out if the extern even exists.
                     broken = False
                     try:
+                        if unpegged:
+                            # Peg it where it lived at its operative rev. Pegged to the top-level rev
+                            # it would look different at every top-level rev, be switched every time
+                            # and never be found in the extern cache.
+                            externUrl = getUrlForRepoAtRevision(externUrl, externRev, externPegrev)
+                            externPegrev = externRev
                         nodekind = getNodeKindForUrl(externUrl, externRev, externPegrev)
                     except CalledProcessError as e:
                         if e.stderr.find("non-existent in revision") != -1:
@@ -359,91 +1806,247 @@ def getExternals(toplevelrevnum):
                                     rev = externRev,
                                     pegrev = externPegrev,
                                     isdirectory=(nodekind == "directory"),
-                                    broken=broken   )
+                                    broken=broken,
+                                    pinned=pinned   )
             except:
                 print "-------- Getting Externals --------"
-                print "Here's the entire text:"
+                print "Here's the entire property:"
                 print text
                 print "Here's the current line:"
                 print line
                 print "Tokens:", tokens
-                print "CWD:", os.getcwd()
+                print "CWD:", cwd or os.getcwd()
                 print "-----------------------------------"
                 raise
 
-def didExternalsChange(revnum):
-    try:
-        text, errtext = readcall("svn diff -c %d %s" % (revnum, rootrepo), timeout=10, printcommand=False, printstdout=False, printstderr=False)
-    except TimeoutException:
-        return True
-    if text.find(": svn:externals") != -1:
-        # found "Modified: svn:externals or "Added: svn:externals"
-        return True
-    else:
-        return False
+def removeExternal(ex, cwd):
+    path = os.path.join(cwd, ex.object)
+    changedPaths.add(path)
+    if os.path.exists(path):
+        if ex.isdirectory or os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+# The externs we set up last time, keyed by the directory they were defined in.
+previousExterns = {}
+previousExternsLock = threading.Lock()
+
+def forgetExternsUnder(path):
+    with previousExternsLock:
+        for directory in previousExterns.keys():
+            if directory == path or directory.startswith(path + os.sep):
+                del previousExterns[directory]
+    externalsIndex.forget(path)
+
+def reconcileExternals(revnum, tree):
+    """Read the externs defined in tree, a (directory, url, rev, pegrev) tuple, and
+    delete the ones that went away since last time. Returns (extern, unchanged) for
+    every extern that should be there."""
+    cwd = tree[0]
+    externs = list(getExternals(revnum, *tree))
+    with previousExternsLock:
+        previous = previousExterns.get(cwd, {})
+    current = dict((ex.object, ex) for ex in externs)
+    for obj, old in previous.iteritems():
+        new = current.get(obj)
+        if new is None or new.isdirectory != old.isdirectory:
+            print "Removing extern %s" % os.path.join(cwd, obj)
+            removeExternal(old, cwd)
+            forgetExternsUnder(os.path.join(cwd, obj))
+    with previousExternsLock:
+        previousExterns[cwd] = current
+    return [(ex, ex.pinned and previous.get(ex.object) == ex and os.path.exists(os.path.join(cwd, ex.object))) for ex in externs]
+
+def clearObstructingExterns(revnum, location, root):
+    """Remove the externs in the way of what revnum adds to the project at location,
+    which is checked out or exported at root. svn won't put a versioned directory
+    where an unversioned one is, and they'd only be removed after the switch."""
+    added = []
+    for changed in revisionIndex.getChangedPaths(revnum):
+        # Replacing the project itself doesn't leave anything unversioned in the way
+        if changed.action in ('A', 'R') and isPathUnder(changed.path, location) and changed.path.rstrip('/') != location.rstrip('/'):
+            added.append(os.path.join(root, changed.path[len(location.rstrip('/')):].lstrip('/')).rstrip(os.sep))
+    if not added:
+        return
+    with previousExternsLock:
+        obstructing = []
+        for directory, current in previousExterns.iteritems():
+            for obj, ex in current.iteritems():
+                path = os.path.normpath(os.path.join(directory, obj))
+                for addedpath in added:
+                    if path == addedpath or path.startswith(addedpath + os.sep) or addedpath.startswith(path + os.sep):
+                        obstructing.append((directory, obj, ex))
+                        break
+        for directory, obj, ex in obstructing:
+            del previousExterns[directory][obj]
+    for directory, obj, ex in obstructing:
+        print "Removing extern %s, rev %d puts something else there" % (os.path.join(directory, obj), revnum)
+        removeExternal(ex, directory)
+        forgetExternsUnder(os.path.join(directory, obj))
+
+def updateExternal(ex, unchanged, cwd):
+    """Fetch a single extern into cwd. Returns (directory, url, rev, pegrev) if it
+    might have externs of its own, otherwise None."""
+    path = os.path.join(cwd, ex.object)
+    if ex.broken:
+        removeExternal(ex, cwd)
+    elif ex.isdirectory:
+        tree = None
+        if externCache is not None and ex.pinned and not unchanged:
+            tree = externCache.lookup(ex)
+        if tree is not None:
+            print "Grafting %s@%d from the extern cache" % (ex.url, ex.pegrev)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            forgetExternsUnder(path)
+            committer.graft(path, tree)
+            return None
+        if not unchanged and os.path.exists(path) and not os.path.exists(os.path.join(path, '.svn')) and os.listdir(path):
+            # Left behind by a graft, and svn won't check out over it.
+            shutil.rmtree(path)
+            changedPaths.add(path)
+        if not os.path.exists(path):
+            os.makedirs(path)
         
-def removeExternal(ex):
-    if os.path.exists(ex.object):
-        if ex.isdirectory or os.path.isdir(ex.object):
-            shutil.rmtree(ex.object)
+        shouldSwitch = not unchanged
+        if not unchanged and not os.path.exists( os.path.join(path, '.svn') ):
+            try:
+                changes = svnClient.checkout(ex.url, ex.object, ex.rev, ex.pegrev, cwd=cwd)
+                print formatSvnChanges(changes)
+                changedPaths.addSvnChanges(changes, cwd)
+                shouldSwitch = False
+            except CalledProcessError as e:
+                if e.stderr.find("is already a working copy for a different URL") != -1:
+                    print e
+                    print "WARNING: Caught working copy / extern conflict, let's try switching"
+                    shouldSwitch = True
+                else:
+                    raise
+            
+        if shouldSwitch:   
+            changes = svnClient.switch(ex.url, ex.object, ex.rev, ex.pegrev, cwd=cwd, ignoreancestry=True)
+            changedPaths.addSvnChanges(changes, cwd)
+            if changes:
+                print formatSvnChanges(changes)
+        return path, ex.url, ex.rev, ex.pegrev
+    elif not unchanged:
+        printexport = False
+        if os.path.exists(path) and not os.path.isdir(path):
+            os.remove(path)
         else:
-            os.remove(ex.object)
-
-def updateExternalsTo(revnum):
-    """Update all externals recursively."""
-    cwd = os.getcwd()
-    for ex in getExternals(revnum):
-        if ex.broken:
-            removeExternal(ex)
+            printexport = True # only print the export if it wasn't here to begin with.
+        
+        # Make the object's directory if it doesn't exist, otherwise 'svn export' will throw an error.
+        objectdir = os.path.dirname(path)
+        if objectdir and not os.path.exists(objectdir):
+            os.makedirs(objectdir)
+            
+        changes = svnClient.export(ex.url, ex.object, ex.rev, ex.pegrev, cwd=cwd)
+        changedPaths.add(path)
+        if printexport:
+            print formatSvnChanges(changes)
+    return None
+
+class JobOutput(object):
+    """Stands in for sys.stdout while there are --jobs threads, so that what one job
+    prints is kept together and comes out in one piece instead of interleaved."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def write(self, text):
+        buffered = getattr(self.local, 'buffered', None)
+        if buffered is None:
+            self.stream.write(text)
         else:
-            if ex.isdirectory:
-                if not os.path.exists(ex.object):
-                    os.makedirs(ex.object)
-                
-                shouldSwitch = True
-                if not os.path.exists( os.path.join(ex.object, '.svn') ):
-                    try:
-                        text, errtext = readcall("svn co --ignore-externals -r %d %s@%d %s" % (ex.rev, ex.url, ex.pegrev, ex.object), printcommand=False, printstdout=True)
-                        shouldSwitch = False
-                    except CalledProcessError as e:
-                        if e.stderr.find("is already a working copy for a different URL") != -1:
-                            print e
-                            print "WARNING: Caught working copy / extern conflict, let's try switching"
-                            shouldSwitch = True
-                        else:
-                            raise
-                    
-                if shouldSwitch:   
-                    text, errtext = readcall("svn switch --ignore-externals --ignore-ancestry -r %d %s@%d %s" % (ex.rev, ex.url, ex.pegrev, ex.object), printcommand=False, printstdout=False, printstderr=False)
-                    if not text.strip().startswith("At revision"):
-                        print text
-                        print >> sys.stderr, errtext                   
-                    
-                os.chdir(ex.object)
-                updateExternalsTo(revnum)
-                os.chdir(cwd)
-            else:
-                printexport = False
-                if os.path.exists(ex.object) and not os.path.isdir(ex.object):
-                    os.remove(ex.object)
-                else:
-                    printexport = True # only print the export if it wasn't here to begin with.
-                
-                # Make the object's directory if it doesn't exist, otherwise 'svn export' will throw an error.
-                objectdir = os.path.dirname(ex.object)
-                if objectdir and not os.path.exists(objectdir):
-                    os.makedirs(objectdir)
-                    
-                text, errtext = readcall("svn export -r %d %s@%d %s" % (ex.rev, ex.url, ex.pegrev, ex.object), printcommand=False, printstdout=False, printstderr=False)
-                if printexport:
-                    print text
-                    print >> sys.stderr, errtext
+            buffered.append(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffered', None) is None:
+            self.stream.flush()
+
+    @contextlib.contextmanager
+    def buffer(self):
+        self.local.buffered = []
+        try:
+            yield
+        finally:
+            text = "".join(self.local.buffered)
+            self.local.buffered = None
+            with self.lock:
+                self.stream.write(text)
+                self.stream.flush()
+
+jobOutput = None
+
+def mapJobs(func, items):
+    """map(), but spread over the --jobs worker threads when there's more than one."""
+    if externalsPool is None or len(items) < 2:
+        return map(func, items)
+    def job(item):
+        with jobOutput.buffer():
+            return func(item)
+    return externalsPool.map(job, items)
+
+def mapJobsByPath(func, items, pathof):
+    """mapJobs(), except that items whose paths are nested run one after another,
+    outermost first, so two threads never work inside the same directory."""
+    groups = []
+    # Sorting by components keeps everything under a path right after it
+    for index in sorted(xrange(len(items)), key=lambda index: pathof(items[index]).split(os.sep)):
+        path = pathof(items[index])
+        if groups and (path == groups[-1][0] or path.startswith(groups[-1][0] + os.sep)):
+            groups[-1][1].append(index)
+        else:
+            groups.append((path, [index]))
+    results = [None] * len(items)
+    for done in mapJobs(lambda group: [(index, func(items[index])) for index in group[1]], groups):
+        for index, result in done:
+            results[index] = result
+    return results
+
+def updateExternalsTo(revnum, cwd, url):
+    """Update all externals recursively in cwd, which holds url at revnum. Returns
+    every extern that was visited.
+    
+    Externs that went away since last time are deleted, ones that point somewhere
+    new are switched, and pinned externs that didn't change are left alone. Sibling
+    externs are fetched in parallel, one level of nesting at a time, except for ones
+    inside each other."""
+    visited = []
+    fetched = []
+    trees = [(cwd, url, revnum, revnum)]
+    while trees:
+        tasks = []
+        for tree, externs in zip(trees, mapJobsByPath(functools.partial(reconcileExternals, revnum), trees, lambda tree: os.path.normpath(tree[0]))):
+            for ex, unchanged in externs:
+                visited.append(ex)
+                tasks.append((ex, unchanged, tree[0]))
+        trees = []
+        for (ex, unchanged, directory), tree in zip(tasks, mapJobsByPath(lambda task: updateExternal(*task), tasks, lambda task: os.path.normpath(os.path.join(task[2], task[0].object)))):
+            if tree is not None:
+                trees.append(tree)
+                if ex.pinned and not unchanged:
+                    fetched.append((ex, tree[0]))
+    if externCache is not None:
+        for ex, path in fetched:
+            if externCache.lookup(ex) is None and isSnapshot(path):
+                print "Saving %s@%d in the extern cache" % (ex.url, ex.pegrev)
+                externCache.store(ex, path)
+    return visited
 
 #
 # Helper Functions
 #
 
 def deleteAllSvnContentInCwd():
+    forgetExternsUnder(os.getcwd())
+    changedPaths.everything()
     for item in os.listdir(os.getcwd()):
         if not item in ['.git']:
             call("rm -fr %s" % item)
@@ -451,13 +2054,17 @@ def deleteAllSvnContentInCwd():
 def updateProjectRootTo(rev):
     ignoreThisChange = False
     try:
-        if os.path.exists('.svn'):
-            text, errtext = readcall("svn switch --ignore-externals --accept theirs-full -r %d %s" % (rev.number, repo), printcommand=False, printstdout=False, printstderr=False)
-            if not text.strip().startswith("At revision"):
-                print text
-                print >> sys.stderr, errtext
+        if os.path.exists(os.path.join(svnroot, '.svn')):
+            changes = svnClient.switch(repo, ".", rev.number, cwd=svnroot, accepttheirs=True)
+            changedPaths.addSvnChanges(changes, svnroot)
+            if changes:
+                print formatSvnChanges(changes)
         else:
-            text, errtext = readcall('svn co --ignore-externals -r %d %s .' % (rev.number, repo), printcommand=False, printstdout=True)
+            if not os.path.exists(svnroot):
+                os.makedirs(svnroot)
+            changes = svnClient.checkout(repo, ".", rev.number, cwd=svnroot)
+            print formatSvnChanges(changes)
+            changedPaths.addSvnChanges(changes, svnroot)
     except CalledProcessError as e:
         if e.stderr.find("Unable to find repository location") != -1:
             print "WARNING: Operative-revision ancestry has a gap here (probably caused by branching from a past revision.) Ignoring this commit."
@@ -470,15 +2077,1295 @@ def updateProjectRootTo(rev):
             raise
     return ignoreThisChange
 
+
+PreparedExport = namedtuple("PreparedExport", ["revnum", "location", "changes", "contents", "externals"])
+
+class ExportTree(object):
+    """The project as a plain export, with no .svn directories to keep up to date.
+    
+    Going from one revision to the next only fetches what the revision index says
+    changed under the project, instead of having 'svn switch' walk a working copy.
+    Anything the index can't describe cheaply, like the project itself being
+    copied or replaced, is exported again from scratch."""
+    def __init__(self, root):
+        self.root = root
+        self.location = None
+        self.url = None
+        self.revnum = None
+
+    def clear(self):
+        forgetExternsUnder(self.root)
+        for item in os.listdir(self.root):
+            if item != '.git':
+                path = os.path.join(self.root, item)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+    def exportAll(self, url, revnum):
+        print "Exporting %s at rev %d" % (url, revnum)
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self.clear()
+        # Externals are replayed separately, or not at all with --no-externals
+        svnClient.export(url, ".", revnum, peg=revnum, cwd=self.root, force=True, ignoreexternals=True)
+        changedPaths.everything()
+
+    def remove(self, relpath):
+        path = os.path.join(self.root, relpath)
+        forgetExternsUnder(path)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+    def writeFile(self, relpath, content, props):
+        path = os.path.join(self.root, relpath)
+        if os.path.lexists(path):
+            self.remove(relpath)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if 'svn:special' in props and content.startswith('link '):
+            os.symlink(content[5:], path)
+            return
+        with open(path, 'wb') as f:
+            f.write(content)
+        if 'svn:executable' in props:
+            os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    def changesSince(self, revnum):
+        """What happened to each path under the project after revnum, boiled down to
+        its last action: 'D' (gone), 'dir', 'tree' (copied in, export it whole) or
+        'file'. Returns None when it's easier to export everything again."""
+        final = {}
+        for r in xrange(self.revnum + 1, revnum + 1):
+            if r not in revisionIndex:
+                return None
+            for changed in sorted(revisionIndex.getChangedPaths(r), key=lambda changed: changed.path):
+                if isPathUnder(self.location, changed.path):
+                    if changed.action != 'M':
+                        # The project itself or a parent was added, replaced or deleted
+                        return None
+                    continue
+                if not isPathUnder(changed.path, self.location):
+                    continue
+                relpath = changed.path[len(self.location.rstrip('/')):].lstrip('/')
+                if changed.action in ('D', 'R') or changed.copyfrompath is not None:
+                    for other in final.keys():
+                        if other.startswith(relpath + '/'):
+                            del final[other]
+                kind = changed.kind
+                if changed.action == 'D':
+                    final[relpath] = 'D'
+                    continue
+                if kind not in ('dir', 'file'):
+                    kind = 'dir' if getNodeKindForUrl(reposroot + urllib.quote(changed.path), r, r) == 'directory' else 'file'
+                if kind == 'dir':
+                    if changed.copyfrompath is not None or changed.action == 'R':
+                        final[relpath] = 'tree'
+                    elif final.get(relpath) != 'tree':
+                        final[relpath] = 'dir'
+                else:
+                    final[relpath] = 'file'
+        return final
+
+    def prepare(self, revnum, location):
+        """Work out what changed up to revnum and fetch it, without touching the tree.
+        Returns a PreparedExport for apply(). The prefetch thread runs this ahead of
+        the replay, so location and revnum are where the tree is headed, not where
+        it is."""
+        changes = None
+        if location == self.location and self.revnum is not None and revnum >= self.revnum:
+            changes = self.changesSince(revnum)
+        self.location = location
+        self.url = reposroot + urllib.quote(location)
+        self.revnum = revnum
+        contents = {}
+        files = [relpath for relpath, action in (changes or {}).iteritems() if action == 'file']
+        if files:
+            urls = dict(("%s/%s" % (self.url, urllib.quote(relpath)), relpath) for relpath in files)
+            for fileurl, content in svnClient.fetchFiles(sorted(urls), revnum).iteritems():
+                contents[urls[fileurl]] = content
+        externals = None
+        if exportexternals:
+            externals = externalsIndex.prefetch(self.root, self.url, revnum)
+        return PreparedExport(revnum=revnum, location=location, changes=changes, contents=contents, externals=externals)
+
+    def apply(self, prepared):
+        """Bring the tree to a prepared revision."""
+        url = reposroot + urllib.quote(prepared.location)
+        if prepared.changes is None:
+            self.exportAll(url, prepared.revnum)
+            self.seed(url, prepared)
+            return False
+
+        for relpath, action in sorted(prepared.changes.iteritems()):
+            changedPaths.add(relpath, self.root)
+            if action in ('D', 'tree'):
+                self.remove(relpath)
+            if action == 'tree':
+                svnClient.export("%s/%s" % (url, urllib.quote(relpath)), relpath, prepared.revnum, peg=prepared.revnum, cwd=self.root, force=True, ignoreexternals=True)
+            elif action == 'dir':
+                if os.path.lexists(os.path.join(self.root, relpath)) and not os.path.isdir(os.path.join(self.root, relpath)):
+                    self.remove(relpath)
+                if not os.path.isdir(os.path.join(self.root, relpath)):
+                    os.makedirs(os.path.join(self.root, relpath))
+        for relpath, (content, props) in sorted(prepared.contents.iteritems()):
+            self.writeFile(relpath, content, props)
+        print "Fetched %d files, %d other changes" % (len(prepared.contents), len(prepared.changes) - len(prepared.contents))
+        self.seed(url, prepared)
+        return False
+
+    def seed(self, url, prepared):
+        # Clearing the tree forgets its externals, so this comes last.
+        if prepared.externals is not None:
+            externalsIndex.seed(self.root, url, prepared.revnum, prepared.externals)
+
+    def update(self, rev, location):
+        """Bring the tree to rev, where the project lives at location."""
+        return self.apply(self.prepare(rev.number, location))
+
+def initGitRepo():
+    """Make the current directory a git repo, if it isn't one yet."""
+    if not os.path.exists('.git'): 
+        call("git init", printcommand=False)
+        with open(".git/info/exclude", 'a') as gitignore:
+            gitignore.write("**/.svn/**\n")
+            gitignore.write(".commitmessage\n")
+
+#
+# Conversion state
+#
+
+class ConversionState(object):
+    """What we've converted so far, in an SQLite database next to the git repo.
+    
+    Besides the last checkpointed revision it keeps the git commit made for every
+    svn revision, and whether the svn working copy and the externs in it are
+    still in one piece. When they are, a restart can carry on with the working
+    copy as it is instead of checking everything out again."""
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS commits (revnum INTEGER PRIMARY KEY, sha TEXT NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS externs (directory TEXT, object TEXT, url TEXT, rev INTEGER, pegrev INTEGER, "
+                            "isdirectory INTEGER, broken INTEGER, pinned INTEGER, PRIMARY KEY (directory, object))")
+        self.savedExterns = None
+
+    def get(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def getProgress(self):
+        """The last revision that's safely in git, or None when starting from scratch."""
+        progress = self.get('progress')
+        if progress is None and os.path.exists('.git/info/progress'):
+            # Converted before there was a state database
+            with open('.git/info/progress', 'r') as gitprogress:
+                progress = gitprogress.read()
+        return int(progress) if progress is not None else None
+
+    def checkpoint(self, revnum, committed):
+        """Record that everything up to revnum is in git, and which commits it made."""
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO commits (revnum, sha) VALUES (?, ?)", committed)
+            self.set('progress', revnum)
+
+    def findCommit(self, revnum):
+        """The git commit holding the tree of revnum: the one for the last revision
+        at or before it that made a commit."""
+        row = self.db.execute("SELECT revnum, sha FROM commits WHERE revnum <= ? ORDER BY revnum DESC LIMIT 1", (revnum,)).fetchone()
+        return row if row else (None, None)
+
+    def invalidateWorkingCopy(self):
+        """Call before svn starts changing the working copy."""
+        with self.db:
+            self.set('workingcopy', 'dirty')
+
+    def saveWorkingCopy(self, revnum, root, externs):
+        """Record that the working copy is whole again at revnum, with these externs
+        (previousExterns, keyed by absolute directory)."""
+        rows = []
+        for directory, current in externs.iteritems():
+            directory = os.path.relpath(directory, root)
+            for ex in current.itervalues():
+                rows.append((directory, ex.object, ex.url, ex.rev, ex.pegrev, ex.isdirectory, ex.broken, ex.pinned))
+        rows.sort()
+        with self.db:
+            if rows != self.savedExterns:
+                self.db.execute("DELETE FROM externs")
+                self.db.executemany("INSERT INTO externs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.savedExterns = rows
+            self.set('workingcopy', 'valid')
+            self.set('workingcopyrev', revnum)
+
+    def loadWorkingCopy(self, root):
+        """Returns (revision, externs) for an intact working copy, or None."""
+        if self.get('workingcopy') != 'valid':
+            return None
+        externs = {}
+        rows = []
+        for row in self.db.execute("SELECT directory, object, url, rev, pegrev, isdirectory, broken, pinned FROM externs"):
+            directory, obj, url, rev, pegrev, isdirectory, broken, pinned = row
+            rows.append((directory, obj, url, rev, pegrev, isdirectory, broken, pinned))
+            ex = Extern(object=obj, url=url, rev=rev, pegrev=pegrev, isdirectory=bool(isdirectory), broken=bool(broken), pinned=bool(pinned))
+            externs.setdefault(os.path.normpath(os.path.join(root, directory)), {})[obj] = ex
+        self.savedExterns = sorted(rows)
+        return int(self.get('workingcopyrev')), externs
+
+    def close(self):
+        self.db.close()
+
+#
+# Extern snapshot cache
+#
+
+class ExternCache(object):
+    """Snapshots of pinned externs as git trees, shared between conversions.
+    
+    The directory holds a bare git repo with the trees, and snapshots.db, which maps
+    (url, rev, pegrev) to a tree in it. A repo converting with the cache borrows its
+    objects through .git/objects/info/alternates until it's done."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.gitdir = os.path.join(directory, 'objects.git')
+        if not os.path.exists(self.gitdir):
+            call('git init -q --bare "%s"' % self.gitdir, printcommand=False)
+        self.lock = threading.Lock()
+        # Other conversions may be writing to it at the same time.
+        self.db = sqlite3.connect(os.path.join(directory, 'snapshots.db'), timeout=60, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS snapshots (url TEXT, rev INTEGER, pegrev INTEGER, tree TEXT NOT NULL, PRIMARY KEY (url, rev, pegrev))")
+    
+    def attach(self):
+        """Let the repo in the current directory see the snapshot trees."""
+        alternates = os.path.join('.git', 'objects', 'info', 'alternates')
+        objects = os.path.join(self.gitdir, 'objects')
+        lines = []
+        if os.path.exists(alternates):
+            with open(alternates, 'r') as f:
+                lines = f.read().splitlines()
+        if objects not in lines:
+            with open(alternates, 'a') as f:
+                f.write(objects + '\n')
+    
+    def detach(self):
+        """Copy every borrowed object the repo uses into it, and stop borrowing."""
+        call("git repack -a -d -q", printcommand=False)
+        alternates = os.path.join('.git', 'objects', 'info', 'alternates')
+        with open(alternates, 'r') as f:
+            lines = [line for line in f.read().splitlines() if line != os.path.join(self.gitdir, 'objects')]
+        if lines:
+            with open(alternates, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+        else:
+            os.remove(alternates)
+    
+    def lookup(self, ex):
+        """The tree for this extern, or None if it hasn't been seen yet."""
+        with self.lock:
+            row = self.db.execute("SELECT tree FROM snapshots WHERE url = ? AND rev = ? AND pegrev = ?", (ex.url, ex.rev, ex.pegrev)).fetchone()
+        return row[0] if row else None
+    
+    def store(self, ex, path):
+        """Snapshot the extern checked out at path, leaving out .svn directories."""
+        fd, indexfile = tempfile.mkstemp(prefix='snapshot', dir=self.directory)
+        os.close(fd)
+        os.remove(indexfile)
+        env = dict(os.environ, GIT_DIR=self.gitdir, GIT_WORK_TREE=path, GIT_INDEX_FILE=indexfile)
+        try:
+            readcall('git add -A -f -- . ":(exclude,glob)**/.svn/**"', printcommand=False, printstdout=False, printstderr=False, cwd=path, env=env)
+            tree, errtext = readcall("git write-tree", printcommand=False, printstdout=False, printstderr=False, cwd=path, env=env)
+        finally:
+            if os.path.exists(indexfile):
+                os.remove(indexfile)
+        tree = tree.strip()
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT OR IGNORE INTO snapshots VALUES (?, ?, ?, ?)", (ex.url, ex.rev, ex.pegrev, tree))
+        return tree
+    
+    def close(self):
+        self.db.close()
+
+externCache = None
+
+def isSnapshot(path):
+    """True if every extern under path is pinned, so what's there doesn't depend on
+    which revision of the project we're at."""
+    with previousExternsLock:
+        for directory, externs in previousExterns.iteritems():
+            if directory == path or directory.startswith(path + os.sep):
+                if not all(ex.pinned for ex in externs.itervalues()):
+                    return False
+    return True
+
+#
+# Git backends
+#
+
+def dateToRaw(date):
+    """Turn '2013-04-19 01:13:18 -0700' into git's raw '1366359198 -0700' format."""
+    match = re.search(r'^([0-9]+-[0-9]+-[0-9]+ [0-9]+:[0-9]+:[0-9]+) ([+-])([0-9]{2})([0-9]{2})', date)
+    if not match:
+        raise ValueError("Can't parse date: %s" % date)
+    localtime, sign, hours, minutes = match.groups()
+    offset = int(hours) * 3600 + int(minutes) * 60
+    if sign == '-':
+        offset = -offset
+    seconds = calendar.timegm(datetime.datetime.strptime(localtime, '%Y-%m-%d %H:%M:%S').timetuple()) - offset
+    return "%d %s%s%s" % (seconds, sign, hours, minutes)
+
+def quoteGitPath(path):
+    """Quote a path the way fast-import expects, if it needs quoting at all."""
+    if not (path.startswith('"') or '\n' in path or '\\' in path):
+        return path
+    return '"%s"' % path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def getGitFileMode(st):
+    if stat.S_ISLNK(st.st_mode):
+        return '120000'
+    if st.st_mode & stat.S_IXUSR:
+        return '100755'
+    return '100644'
+
+def readWorkTreeFile(path, mode):
+    if mode == '120000':
+        return os.readlink(path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+# Blob marks start well above any revision number, which is what commits are marked with.
+BLOBMARKBASE = 1 << 32
+
+def hashBlob(data):
+    return hashlib.sha1("blob %d\0%s" % (len(data), data)).hexdigest()
+
+def isUnderAny(path, parents):
+    """True if path or one of its parent directories is in the set parents."""
+    while path:
+        if path in parents:
+            return True
+        path = os.path.dirname(path)
+    return '.' in parents
+
+def walkWorkTreeFiles(top):
+    """Yield every file git should know about under top, skipping .svn directories."""
+    for dirpath, dirnames, filenames in os.walk(top):
+        if '.svn' in dirnames:
+            dirnames.remove('.svn')
+        if dirpath == '.' and '.git' in dirnames:
+            dirnames.remove('.git')
+        # Symlinks to directories are files as far as git is concerned
+        for dirname in list(dirnames):
+            if os.path.islink(os.path.join(dirpath, dirname)):
+                dirnames.remove(dirname)
+                filenames.append(dirname)
+        for filename in filenames:
+            yield os.path.normpath(os.path.join(dirpath, filename))
+
+class WorkTreeScanner(object):
+    """Remembers what the work tree looked like at the last commit.
+    
+    Files are only read and hashed when their stat info changed, and .svn
+    directories are never looked at, so they can't end up in a commit."""
+    def __init__(self):
+        self.known = {}
+
+    def loadFromTree(self, treeish):
+        """Start from the contents of an existing commit, e.g. when resuming."""
+        self.known = {}
+        text, errtext = readcall("git ls-tree -r -z %s" % treeish, printcommand=False, printstdout=False, printstderr=False)
+        for entry in text.split('\0'):
+            if entry:
+                info, path = entry.split('\t', 1)
+                mode, kind, sha = info.split()
+                if kind == 'blob':
+                    self.known[path] = (None, mode, sha)
+
+    def candidates(self, paths):
+        """The files that might have changed when svn touched paths."""
+        for path in paths:
+            if isSvnMetadataPath(path):
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                for child in walkWorkTreeFiles(path):
+                    yield child
+            elif os.path.lexists(path):
+                yield path
+
+    def scan(self, paths=None):
+        """Returns (changed, deleted) paths since the last scan. If paths is given,
+        only those paths (and anything under them) are looked at."""
+        changed = []
+        seen = set()
+        if paths is None:
+            candidates = walkWorkTreeFiles('.')
+        else:
+            paths = [os.path.normpath(path) for path in paths]
+            candidates = self.candidates(paths)
+        for path in candidates:
+            seen.add(path)
+            st = os.lstat(path)
+            statkey = (st.st_mode, st.st_size, st.st_mtime, st.st_ino)
+            previous = self.known.get(path)
+            if previous is not None and previous[0] == statkey:
+                continue
+            mode = getGitFileMode(st)
+            sha = hashBlob(readWorkTreeFile(path, mode))
+            self.known[path] = (statkey, mode, sha)
+            if previous is None or previous[1] != mode or previous[2] != sha:
+                changed.append(path)
+        if paths is None:
+            deleted = [path for path in self.known if path not in seen]
+        else:
+            touched = set(paths)
+            deleted = [path for path in self.known if path not in seen and isUnderAny(path, touched)]
+        for path in deleted:
+            del self.known[path]
+        return changed, deleted
+
+class GitIndexBackend(object):
+    """Commit with 'git commit', staging only the paths svn told us about when we know them."""
+    def __init__(self, svnmetadata=True):
+        self.committed = []
+        # False when nothing in the work tree is an svn working copy
+        self.svnmetadata = svnmetadata
+        self.lock = threading.Lock()
+
+    def graft(self, path, tree):
+        """Put an existing tree at path, in both the index and the work tree, without
+        hashing anything."""
+        path = os.path.relpath(path)
+        with self.lock:
+            subprocess.check_call(['git', 'rm', '-r', '-q', '--cached', '--ignore-unmatch', '--', path])
+            metrics.recordProcess()
+            subprocess.check_call(['git', 'read-tree', '--prefix=%s/' % path, tree])
+            metrics.recordProcess()
+            text = subprocess.check_output(['git', '--literal-pathspecs', 'ls-files', '-z', '--', path])
+            metrics.recordProcess(len(text))
+            # Writes the files and refreshes their stat info, so 'git add' skips them.
+            p = subprocess.Popen(['git', 'checkout-index', '-f', '-z', '--stdin'], stdin=subprocess.PIPE)
+            metrics.recordProcess()
+            p.communicate(text)
+            if p.returncode != 0:
+                raise CalledProcessError(p.returncode, "git checkout-index", None, None)
+
+    def commit(self, rev, message, paths=None):
+        with metrics.phase('stage'):
+            if paths is None:
+                self.stageEverything()
+            else:
+                self.stagePaths(paths)
+        
+        with open(".git/info/commitmessage", 'w') as commitmessage:
+            commitmessage.write(message)
+            
+        # The svn date is the committer date too, so commits don't need rewriting later
+        # and come out identical every time they're converted.
+        env = dict(os.environ, GIT_COMMITTER_DATE=rev.date)
+        try:
+            with metrics.phase('git commit'):
+                text, errtext = readcall('git commit --author="%s" --date="%s" --file=.git/info/commitmessage' % (rev.user, rev.date), printcommand=False, printstdout=False, printstderr=False, env=env)
+                print text
+                print >> sys.stderr, errtext
+                text, errtext = readcall("git rev-parse HEAD", printcommand=False, printstdout=False, printstderr=False)
+                self.committed.append((rev.number, text.strip()))
+        except CalledProcessError as e:
+            if e.stdout.find("nothing to commit") != -1:
+                pass
+            else:
+                raise
+        
+        os.remove(".git/info/commitmessage")
+
+    def stagePaths(self, paths):
+        """Update just these index entries with 'git update-index', never touching .svn."""
+        paths = [path for path in paths if not isSvnMetadataPath(path)]
+        if not paths:
+            return
+        # Anything the index has under these paths might have gone away.
+        indexed = set()
+        for i in xrange(0, len(paths), 100):
+            args = ['git', '--literal-pathspecs', 'ls-files', '-z', '--'] + paths[i:i + 100]
+            text = subprocess.check_output(args)
+            metrics.recordProcess(len(text))
+            indexed.update(entry for entry in text.split('\0') if entry)
+        update = set(indexed)
+        forceremove = []
+        for path in paths:
+            if os.path.isdir(path) and not os.path.islink(path):
+                if path in indexed:
+                    # Used to be a file, now it's a directory
+                    update.discard(path)
+                    forceremove.append(path)
+                update.update(walkWorkTreeFiles(path))
+            else:
+                update.add(path)
+        if forceremove:
+            p = subprocess.Popen(['git', 'update-index', '-z', '--force-remove', '--stdin'], stdin=subprocess.PIPE)
+            metrics.recordProcess()
+            p.communicate('\0'.join(forceremove) + '\0')
+            if p.returncode != 0:
+                raise CalledProcessError(p.returncode, "git update-index --force-remove", None, None)
+        p = subprocess.Popen(['git', 'update-index', '-z', '--add', '--remove', '--stdin'], stdin=subprocess.PIPE)
+        metrics.recordProcess()
+        # Removals go first so a directory can turn into a file and vice versa.
+        update = sorted(update, key=lambda path: (os.path.lexists(path), path))
+        p.communicate('\0'.join(update) + '\0')
+        if p.returncode != 0:
+            raise CalledProcessError(p.returncode, "git update-index --add --remove", None, None)
+
+    def stageEverything(self):
+        # Add everything. New files, modifications, deletions.
+        text, errtext = readcall("git add -f -u .", printcommand=False, printstdout=False, printstderr=False)
+        text, errtext = readcall("git add -f --all .", printcommand=False, printstdout=False, printstderr=False)
+        
+        
+        if not self.svnmetadata:
+            return
+        # Remove all .svn directories from the cache
+        with metrics.phase('.svn removal'):
+            text, errtext = readcall("git ls-files -c -i --exclude '**/.svn/wc.db' ", printcommand=False, printstdout=False, printstderr=False)
+            svndirs = set()
+            for line in text.splitlines():
+                match = re.search(r'^(.*\.svn)/', line)
+                if match:
+                    svndirs.add(match.group(1))
+            svndirs = list(svndirs)            
+            while svndirs:
+                cmd = "git rm --cached -r"
+                dirsperline = 10
+                while svndirs and dirsperline > 0:
+                    cmd += " \"%s\"" % svndirs.pop()
+                    dirsperline -= 1
+                
+                text, errtext = readcall(cmd, printcommand=False, printstdout=False, printstderr=False)
+
+    def checkpoint(self, force=False):
+        """Returns True once everything committed so far is safely on disk. With
+        force it always is, however little has been committed since the last time."""
+        return True
+
+    def commitIds(self):
+        """(svn revision, git commit) for everything committed since the last call."""
+        committed = self.committed
+        self.committed = []
+        return committed
+
+    def close(self):
+        pass
+
+class GitFastImportBackend(object):
+    """Commit by streaming only the changed files into one long-running 'git fast-import'."""
+    def __init__(self, branch='refs/heads/master', checkpointinterval=100):
+        self.branch = branch
+        self.checkpointinterval = checkpointinterval
+        self.uncheckpointed = 0
+        self.scanner = WorkTreeScanner()
+        self.parent = None
+        self.nextblobmark = BLOBMARKBASE
+        self.committed = []
+        self.grafts = []
+        self.lock = threading.Lock()
+        try:
+            readcall("git rev-parse --verify -q %s" % branch, printcommand=False, printstdout=False, printstderr=False)
+            self.parent = "%s^0" % branch
+        except CalledProcessError:
+            pass
+        args = ['git', 'fast-import', '--quiet', '--cat-blob-fd=1', '--export-marks=.git/info/marks', '--import-marks-if-exists=.git/info/marks']
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def write(self, text):
+        self.process.stdin.write(text)
+
+    def writeData(self, data):
+        self.write("data %d\n" % len(data))
+        self.write(data)
+        self.write("\n")
+
+    def blob(self, data):
+        """Store a blob and return the mark that refers to it."""
+        mark = ":%d" % self.nextblobmark
+        self.nextblobmark += 1
+        self.write("blob\nmark %s\n" % mark)
+        self.writeData(data)
+        return mark
+
+    def catBlob(self, dataref):
+        """Read back the content of a blob we sent earlier."""
+        self.write("cat-blob %s\n" % dataref)
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3 or header[1] != 'blob':
+            raise RuntimeError("git fast-import couldn't find blob %s: %s" % (dataref, ' '.join(header)))
+        data = self.process.stdout.read(int(header[2]))
+        self.process.stdout.read(1)
+        return data
+
+    def writeCommit(self, rev, message, deleted, modified, deleteall=False):
+        """Write one commit. modified is a list of (path, mode, dataref, data);
+        data is only used when dataref is 'inline'."""
+        when = dateToRaw(rev.date)
+        self.write("commit %s\n" % self.branch)
+        self.write("mark :%d\n" % rev.number)
+        self.write("author %s %s\n" % (rev.user, when))
+        self.write("committer %s %s\n" % (rev.user, when))
+        self.writeData(message)
+        if self.parent:
+            self.write("from %s\n" % self.parent)
+            self.parent = None
+        if deleteall:
+            self.write("deleteall\n")
+        for path in deleted:
+            self.write("D %s\n" % quoteGitPath(path))
+        for path, mode, dataref, data in modified:
+            self.write("M %s %s %s\n" % (mode, dataref, quoteGitPath(path)))
+            if dataref == 'inline':
+                self.writeData(data)
+        self.write("\n")
+        self.uncheckpointed += 1
+        self.committed.append(rev.number)
+
+    def loadKnown(self):
+        if self.parent and not self.scanner.known:
+            self.scanner.loadFromTree(self.branch)
+
+    def graft(self, path, tree):
+        """Check an existing tree out at path, and refer to it by id in the next commit
+        instead of sending its files."""
+        path = os.path.relpath(path)
+        fd, indexfile = tempfile.mkstemp(prefix='graft', dir=os.path.join('.git', 'info'))
+        os.close(fd)
+        os.remove(indexfile)
+        env = dict(os.environ, GIT_INDEX_FILE=indexfile)
+        try:
+            subprocess.check_call(['git', 'read-tree', '--prefix=%s/' % path, tree], env=env)
+            metrics.recordProcess()
+            subprocess.check_call(['git', 'checkout-index', '-a', '-f'], env=env)
+            metrics.recordProcess()
+        finally:
+            if os.path.exists(indexfile):
+                os.remove(indexfile)
+        text = subprocess.check_output(['git', 'ls-tree', '-r', '-z', tree])
+        metrics.recordProcess(len(text))
+        with self.lock:
+            self.loadKnown()
+            for known in self.scanner.known.keys():
+                if known == path or known.startswith(path + os.sep):
+                    del self.scanner.known[known]
+            # Now the scanner knows the files are already in the commit.
+            for entry in text.split('\0'):
+                if entry:
+                    info, child = entry.split('\t', 1)
+                    mode, kind, sha = info.split()
+                    child = os.path.join(path, child)
+                    st = os.lstat(child)
+                    self.scanner.known[child] = ((st.st_mode, st.st_size, st.st_mtime, st.st_ino), mode, sha)
+            self.grafts.append((path, tree))
+
+    def commit(self, rev, message, paths=None):
+        with metrics.phase('stage'):
+            self.loadKnown()
+            changed, deleted = self.scanner.scan(paths)
+        grafts = self.grafts
+        self.grafts = []
+        if not changed and not deleted and not grafts:
+            print "Nothing to commit for rev %d" % rev.number
+            return
+        with metrics.phase('git commit'):
+            modified = [(path, '040000', tree, None) for path, tree in grafts]
+            for path in changed:
+                mode = self.scanner.known[path][1]
+                modified.append((path, mode, 'inline', readWorkTreeFile(path, mode)))
+            self.writeCommit(rev, message, deleted, modified)
+        print "Committed rev %d: %d changed, %d deleted" % (rev.number, len(changed), len(deleted))
+
+    def sync(self, tag):
+        """Wait until fast-import has caught up with everything we've sent."""
+        self.write("progress %s\n" % tag)
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError("git fast-import exited unexpectedly")
+
+    def checkpoint(self, force=False):
+        if self.uncheckpointed == 0 or (self.uncheckpointed < self.checkpointinterval and not force):
+            return self.uncheckpointed == 0
+        self.write("checkpoint\n")
+        self.sync("checkpoint")
+        self.uncheckpointed = 0
+        return True
+
+    def commitIds(self):
+        committed = []
+        for revnum in self.committed:
+            self.write("get-mark :%d\n" % revnum)
+            self.process.stdin.flush()
+            committed.append((revnum, self.process.stdout.readline().strip()))
+        self.committed = []
+        return committed
+
+    def close(self):
+        self.write("done\n")
+        self.process.stdin.close()
+        self.process.wait()
+        if self.process.returncode != 0:
+            raise CalledProcessError(self.process.returncode, "git fast-import", None, None)
+        self.uncheckpointed = 0
+        # Keep the index in step with the new HEAD so git status makes sense
+        call("git read-tree HEAD", printcommand=False)
+
+#
+# Dump stream replay
+#
+
+DumpNode = namedtuple("DumpNode", ["kind", "dataref", "props"])
+
+class NodeHistory(object):
+    """Every version of every node in the repository, so copies from old revisions can be resolved."""
+    def __init__(self):
+        self.revs = {}
+        self.nodes = {}
+        self.sortedpaths = []
+
+    def set(self, path, revnum, node):
+        if path not in self.revs:
+            self.revs[path] = []
+            self.nodes[path] = []
+            bisect.insort(self.sortedpaths, path)
+        revs = self.revs[path]
+        if revs and revs[-1] == revnum:
+            self.nodes[path][-1] = node
+        else:
+            revs.append(revnum)
+            self.nodes[path].append(node)
+
+    def get(self, path, revnum=None):
+        if path not in self.revs:
+            return None
+        if revnum is None:
+            return self.nodes[path][-1]
+        i = bisect.bisect_right(self.revs[path], revnum)
+        if i == 0:
+            return None
+        return self.nodes[path][i - 1]
+
+    def subtree(self, path, revnum=None):
+        """Yield (path, node) for path and everything under it that exists at revnum."""
+        node = self.get(path, revnum)
+        if node is not None:
+            yield path, node
+        prefix = path.rstrip('/') + '/'
+        i = bisect.bisect_left(self.sortedpaths, prefix)
+        while i < len(self.sortedpaths) and self.sortedpaths[i].startswith(prefix):
+            child = self.sortedpaths[i]
+            node = self.get(child, revnum)
+            if node is not None:
+                yield child, node
+            i += 1
+
+class DumpReplayer(object):
+    """Replays a dump stream straight into git fast-import, without an svn working copy.
+    
+    Only the part of the tree under the --repo location (as given by the revision
+    plan) ends up in the commits. Blobs and node history are kept for that, and for
+    wherever anything in it was copied from, so that those copies can be resolved."""
+    def __init__(self, committer, plan, startrevnum, prefix=''):
+        self.committer = committer
+        self.prefix = prefix
+        self.plan = plan
+        self.startrevnum = startrevnum
+        self.kept = None
+        if plan is not None:
+            self.kept = sorted(getCopySources(plan.index, [path for startrevnum, endrevnum, path in plan.locations]))
+        self.history = NodeHistory()
+        self.blobs = {}
+        self.links = {}
+        self.emitted = None
+        self.location = None
+        self.lastrevnum = None
+
+    def isKept(self, path):
+        """True if path is part of what's kept, or a directory above some of it."""
+        if self.kept is None:
+            return True
+        return any(isPathUnder(path, kept) or isPathUnder(kept, path) for kept in self.kept)
+
+    def storeBlob(self, data):
+        sha = hashlib.sha1(data).hexdigest()
+        if sha not in self.blobs:
+            self.blobs[sha] = self.committer.blob(data)
+        return self.blobs[sha]
+
+    def getContent(self, node):
+        if node is None or node.dataref is None:
+            return ""
+        return self.committer.catBlob(node.dataref)
+
+    def delete(self, path, revnum, dirty):
+        for child, node in list(self.history.subtree(path)):
+            self.history.set(child, revnum, None)
+            dirty.add(child)
+
+    def applyNode(self, record, revnum, dirty):
+        headers = record.headers
+        path = '/' + headers['Node-path'].strip('/')
+        if not self.isKept(path):
+            return
+        action = headers['Node-action']
+        if action in ('delete', 'replace'):
+            self.delete(path, revnum, dirty)
+        if action == 'delete':
+            return
+
+        node = None
+        if action == 'change':
+            node = self.history.get(path)
+        elif 'Node-copyfrom-path' in headers:
+            copyfrompath = '/' + headers['Node-copyfrom-path'].strip('/')
+            copyfromrev = int(headers['Node-copyfrom-rev'])
+            for child, childnode in list(self.history.subtree(copyfrompath, copyfromrev)):
+                childpath = path + child[len(copyfrompath):]
+                if self.isKept(childpath):
+                    self.history.set(childpath, revnum, childnode)
+                    dirty.add(childpath)
+            node = self.history.get(path)
+        if node is None:
+            node = DumpNode(kind=headers.get('Node-kind'), dataref=None, props={})
+
+        props = node.props
+        if record.props is not None:
+            if headers.get('Prop-delta') == 'true':
+                props = dict(props)
+                props.update(record.props)
+                for key in record.propdeletes:
+                    props.pop(key, None)
+            else:
+                props = record.props
+
+        dataref = node.dataref
+        if record.text is not None:
+            if headers.get('Text-delta') == 'true':
+                text = svndump.applySvndiff(self.getContent(node), record.text)
+            else:
+                text = record.text
+            dataref = self.storeBlob(text)
+
+        self.history.set(path, revnum, DumpNode(kind=node.kind or headers.get('Node-kind'), dataref=dataref, props=props))
+        dirty.add(path)
+
+    def gitEntry(self, node):
+        """Returns (mode, dataref) for a file node."""
+        if 'svn:special' in node.props:
+            # Symlinks are stored in svn as 'link TARGET'
+            if node.dataref not in self.links:
+                target = self.getContent(node)
+                if target.startswith('link '):
+                    target = target[5:]
+                self.links[node.dataref] = self.storeBlob(target)
+            return '120000', self.links[node.dataref]
+        if 'svn:executable' in node.props:
+            return '100755', node.dataref
+        return '100644', node.dataref
+
+    def listLocation(self, location):
+        entries = {}
+        for path, node in self.history.subtree(location):
+            if node.kind == 'file':
+                entries[path[len(location):].lstrip('/')] = self.gitEntry(node)
+        return entries
+
+    def commitRevision(self, rev, dirty):
+        location = self.plan.locationAt(rev.number) if self.plan else None
+        if location is None:
+            return
+        deleteall = False
+        if self.emitted is None or location != self.location:
+            # First commit, or the project moved: write out the whole tree.
+            deleteall = True
+            entries = self.listLocation(location)
+            deleted = []
+            modified = [(path, mode, dataref, None) for path, (mode, dataref) in sorted(entries.iteritems())]
+            if self.emitted == entries:
+                modified = []
+            self.emitted = entries
+            self.location = location
+        else:
+            deleted = []
+            modified = []
+            for path in sorted(dirty):
+                if not isPathUnder(path, location):
+                    continue
+                relpath = path[len(location):].lstrip('/')
+                node = self.history.get(path)
+                if node is not None and node.kind == 'file':
+                    entry = self.gitEntry(node)
+                    if self.emitted.get(relpath) != entry:
+                        self.emitted[relpath] = entry
+                        modified.append((relpath, entry[0], entry[1], None))
+                elif relpath in self.emitted:
+                    del self.emitted[relpath]
+                    deleted.append(relpath)
+        if not deleted and not modified:
+            print "Nothing to commit for rev %d" % rev.number
+            return
+        if self.prefix:
+            deleted = [posixpath.join(self.prefix, path) for path in deleted]
+            modified = [(posixpath.join(self.prefix, path), mode, dataref, data) for path, mode, dataref, data in modified]
+        self.committer.writeCommit(rev, "%s\n\nExported from rev %d %s" % (rev.log, rev.number, repo), deleted, modified, deleteall)
+        print "Committed rev %d: %d changed, %d deleted" % (rev.number, len(modified), len(deleted))
+
+    def replay(self, stream):
+        revnum = None
+        revprops = None
+        dirty = set()
+        for record in svndump.readRecords(stream):
+            if 'Revision-number' in record.headers:
+                if revnum is not None:
+                    self.finishRevision(revnum, revprops, dirty)
+                revnum = int(record.headers['Revision-number'])
+                revprops = record.props or {}
+                dirty = set()
+                print "-- Replaying revision %d --" % revnum
+            elif 'Node-path' in record.headers:
+                self.applyNode(record, revnum, dirty)
+        if revnum is not None:
+            self.finishRevision(revnum, revprops, dirty)
+
+    def finishRevision(self, revnum, revprops, dirty):
+        if dirty and revnum >= self.startrevnum:
+            author = revprops.get('svn:author')
+            if author not in userLookup:
+                raise ValueError("No git user found for %s at revision %d" % (author, revnum))
+            rev = Revision(number=revnum, user=userLookup[author], date=parseXmlDate(revprops['svn:date']), log=revprops.get('svn:log', ""))
+            self.commitRevision(rev, dirty)
+        self.lastrevnum = revnum
+        if revnum >= self.startrevnum and self.committer.checkpoint():
+            conversionState.checkpoint(revnum, self.committer.commitIds())
             
+#
+# Sharding
+#
+
+def splitRevisions(plan, revnumbers, count):
+    """Cut revnumbers into count contiguous (first, last) ranges with about the same
+    number of revisions to replay in each."""
+    relevant = [revnum for revnum in revnumbers if plan.isRelevant(revnum)]
+    if not relevant:
+        return [(revnumbers[0], revnumbers[-1])]
+    count = max(1, min(count, len(relevant)))
+    starts = [revnumbers[0]] + [relevant[i * len(relevant) / count] for i in xrange(1, count)]
+    starts = sorted(set(starts))
+    return [(start, (starts[i + 1] - 1) if i + 1 < len(starts) else revnumbers[-1]) for i, start in enumerate(starts)]
+
+def convertShards(ranges, shardroot, workerargs):
+    """Run one convert_to_git.py per range at the same time, each into its own repo
+    under shardroot. Returns the repo directories in order."""
+    directories = []
+    processes = []
+    for i, (first, last) in enumerate(ranges):
+        directory = os.path.join(shardroot, "shard%d" % i)
+        directories.append(directory)
+        logfile = directory + ".log"
+        args = workerargs + ['--range', '%d:%d' % (first, last), directory]
+        print "Shard %d: revs %d to %d (log in %s)" % (i, first, last, logfile)
+        with open(logfile, 'a') as log:
+            processes.append(subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT))
+        metrics.recordProcess()
+    failures = []
+    for i, p in enumerate(processes):
+        p.wait()
+        if p.returncode != 0:
+            failures.append("  shard %d exited with %d, see %s.log" % (i, p.returncode, directories[i]))
+    if failures:
+        raise RuntimeError("Converting %d shards failed:\n%s" % (len(failures), "\n".join(failures)))
+    return directories
+
+def stitchShards(directories):
+    """Chain the shards onto our own history. Returns (svn revision, git commit) for
+    every commit made."""
+    shardrevnums = []
+    for directory in directories:
+        state = ConversionState(os.path.join(directory, '.git', 'info', 'state.db'))
+        shardrevnums.append([row[0] for row in state.db.execute("SELECT revnum FROM commits ORDER BY revnum")])
+        state.close()
+    written = git_date_merge.chain(directories)
+    text, errtext = readcall("git rev-list --reverse HEAD", printcommand=False, printstdout=False, printstderr=False)
+    shas = text.split()[-len(written):] if written else []
+    return [(shardrevnums[index][sequence], sha) for (index, sequence), sha in zip(written, shas)]
+
+#
+# Replaying revisions
+#
+
+def replayRevision(revnum):
+    """Bring svnroot to revnum, externals and all, and commit it."""
+    print "-- Replaying revision %d --" % revnum
+    metrics.startRevision(revnum)
+    rev = getRevision(revnum)
+    
+    ignoreThisChange = False
+    conversionState.invalidateWorkingCopy()
+    
+    # Externals that changed are reconciled one by one in updateExternalsTo, but
+    # the ones in the way of the project's own changes have to go first.
+    if exportexternals and revisionPlan.locationAt(revnum) is not None:
+        clearObstructingExterns(revnum, revisionPlan.locationAt(revnum), svnroot)
+    if revisionPlan.locationAt(revnum) is None:
+        # We already know from the copy history that 'svn switch' would fail here.
+        print "WARNING: Operative-revision ancestry has a gap here (probably caused by branching from a past revision.) Ignoring this commit."
+        ignoreThisChange = True
+    elif exportTree is not None:
+        with metrics.phase('export'):
+            if prefetcher is None:
+                ignoreThisChange = exportTree.update(rev, revisionPlan.locationAt(revnum))
+            else:
+                prepared = prefetcher.get(revnum)
+                # Nothing was prepared if the project itself didn't change
+                if prepared is not None:
+                    ignoreThisChange = exportTree.apply(prepared)
+    else:
+        with metrics.phase('svn switch'):
+            ignoreThisChange = updateProjectRootTo(rev)
+    
+    if not ignoreThisChange:
+        if exportexternals:
+            with metrics.phase('externals'):
+                url = reposroot + urllib.quote(revisionPlan.locationAt(revnum))
+                revisionPlan.setExterns(updateExternalsTo(rev.number, svnroot, url))
+
+        committer.commit(rev, "%s\n\nExported from rev %d %s" % (rev.log, rev.number, repo), changedPaths.paths)
+        changedPaths.reset()
+    with previousExternsLock:
+        externs = dict((directory, current) for directory, current in previousExterns.iteritems() if directory == changedPaths.root or directory.startswith(changedPaths.root + os.sep))
+        conversionState.saveWorkingCopy(rev.number, changedPaths.root, externs)
+
+    with metrics.phase('checkpoint'):
+        if committer.checkpoint():
+            conversionState.checkpoint(rev.number, committer.commitIds())
+    metrics.finishRevision()
+
+class Prefetcher(object):
+    """Runs prepare(revnum) for the upcoming revisions on a thread of its own, at most
+    depth revisions ahead of the replay, so svn is busy fetching the next revision
+    while git commits this one."""
+    def __init__(self, revnums, prepare, depth):
+        self.queue = Queue.Queue(depth)
+        self.pending = None
+        self.thread = threading.Thread(target=self.run, args=(revnums, prepare))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, revnums, prepare):
+        with metrics.background('prefetch'):
+            try:
+                for revnum in revnums:
+                    self.queue.put((revnum, prepare(revnum), None))
+            except Exception:
+                self.queue.put((None, None, sys.exc_info()))
+                return
+        self.queue.put((None, None, None))
+
+    def get(self, revnum):
+        """What was prepared for revnum, or None if revnum was skipped."""
+        if self.pending is None:
+            self.pending = self.queue.get()
+        nextrevnum, prepared, error = self.pending
+        if error is not None:
+            raise error[0], error[1], error[2]
+        if nextrevnum is None or nextrevnum > revnum:
+            return None
+        if nextrevnum < revnum:
+            raise RuntimeError("Revision %d was prefetched but never replayed" % nextrevnum)
+        self.pending = None
+        return prepared
+
+prefetcher = None
+
+def prefetchRevisions(revnumbers, replayfirst=True):
+    """The revisions the replay will want the project's content for, in order: the
+    first one (unless replayfirst is off), and every later one that changed the project."""
+    first = replayfirst
+    for revnum in revnumbers:
+        if revisionPlan.locationAt(revnum) is not None and (first or revisionPlan.touchesProject(revnum)):
+            yield revnum
+        first = False
+
+def prepareRevision(revnum):
+    return exportTree.prepare(revnum, revisionPlan.locationAt(revnum))
+
+#
+# Multi-target conversion
+#
+
+class TargetConversion(object):
+    """One --target of a multi-target conversion, with its own plan, export tree, git
+    repo and state. The revision index, svn access and extern cache are shared."""
+    def __init__(self, repo, prefix, directory):
+        self.repo = repo
+        self.directory = os.path.abspath(directory)
+        self.svnroot = os.path.join(self.directory, prefix) if prefix else self.directory
+        self.exportTree = ExportTree(self.svnroot)
+        self.changedPaths = ChangedPaths()
+        self.changedPaths.setRoot(self.directory)
+        self.state = None
+        self.startrevnum = None
+        self.revisionPlan = None
+        self.committer = None
+        self.revisions = None
+        self.nextrevnum = None
+
+    def open(self):
+        """Create or reopen the git repo, and work out where to start."""
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        os.chdir(self.directory)
+        initGitRepo()
+        self.state = ConversionState(".git/info/state.db")
+        if externCache is not None:
+            externCache.attach()
+        progress = self.state.getProgress()
+        if progress is not None:
+            print "-- Continuing %s from rev %d --" % (self.repo, progress)
+            self.startrevnum = progress
+        else:
+            self.startrevnum = getFirstRevision(self.repo).number
+            print "-- Starting %s from scratch from rev %d --" % (self.repo, self.startrevnum)
+
+    def start(self, lastrevnum):
+        """Plan the revisions to replay, once the revision index is loaded."""
+        self.revisionPlan = RevisionPlan(revisionIndex, urlToRepositoryPath(self.repo), self.startrevnum, lastrevnum)
+        for startrevnum, endrevnum, path in self.revisionPlan.locations:
+            print "%s from rev %d to rev %d" % (path, startrevnum, endrevnum)
+        os.chdir(self.directory)
+        self.committer = GitFastImportBackend()
+        # Lazily, so externs found along the way are watched too.
+        self.revisions = self.revisionPlan.select(xrange(self.startrevnum, lastrevnum + 1))
+        self.advance()
+
+    def advance(self):
+        self.nextrevnum = next(self.revisions, None)
+
+    def activate(self):
+        """Switch to this target. Returns what replayRevision needs, for the globals:
+        (repo, svnroot, exportTree, changedPaths, committer, revisionPlan, conversionState)."""
+        os.chdir(self.directory)
+        return self.repo, self.svnroot, self.exportTree, self.changedPaths, self.committer, self.revisionPlan, self.state
+
+    def finish(self, lastrevnum):
+        os.chdir(self.directory)
+        committed = self.committer.commitIds()
+        self.committer.close()
+        self.state.checkpoint(lastrevnum, committed)
+        self.state.close()
+        if externCache is not None:
+            externCache.detach()
+
+#
+# Following new revisions
+#
+
+def openNotifications(path):
+    """The FIFO at path that --notify writes to, to wake us up early. We hold the
+    write end open too, so select() doesn't keep seeing the end of the file once a
+    notifier is gone."""
+    if not os.path.exists(path):
+        os.mkfifo(path)
+    return os.open(path, os.O_RDWR | os.O_NONBLOCK)
+
+def sendNotification(path):
+    """Wake up the conversion following at path, if there is one. Never blocks, so
+    it's safe to call from a hook. Returns True if someone was listening."""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError as e:
+        # Nobody made the FIFO, or nobody has it open
+        if e.errno in (errno.ENOENT, errno.ENXIO):
+            return False
+        raise
+    try:
+        os.write(fd, "\n")
+    except OSError as e:
+        # A full pipe already has plenty of wakeups in it
+        if e.errno != errno.EAGAIN:
+            raise
+    finally:
+        os.close(fd)
+    return True
+
+def waitForRevisions(url, lastrevnum, pollseconds, notifications):
+    """Block until url's repository has complete revisions after lastrevnum, and
+    return the youngest of them. Looks every pollseconds, or as soon as a
+    notification comes in."""
+    while True:
+        youngest = getYoungestRevnum(url)
+        if youngest > lastrevnum:
+            return youngest
+        readable, writable, failed = select.select([notifications], [], [], pollseconds)
+        if readable:
+            try:
+                while os.read(notifications, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
 #============================================================#
 
 #
 # Parse input parameters
 #      
             
-rootrepo, repo, remoterepos, targetdir, usersfile, checkancestry, exportexternals = parseOptions()
+rootrepo, repo, remoterepos, targetdir, usersfile, checkancestry, exportexternals, fastimport, dumpfile, jobs, prefix, svnbackend, findrev, metricsfile, exporttree, shards, revrange, externalsdump, externcache, targets, prefetchdepth, follow, pollseconds, notify, svntimeout, svnretries = parseOptions()
+
+if notify:
+    sendNotification(os.path.join(targetdir, '.git', 'info', 'follow'))
+    exit()
+
+if findrev != None:
+    if not os.path.exists(os.path.join(targetdir, '.git', 'info', 'state.db')):
+        usagequit("No conversion state in %s" % targetdir)
+    os.chdir(targetdir)
+    revnum, sha = ConversionState('.git/info/state.db').findCommit(findrev)
+    if sha is None:
+        print >> sys.stderr, "No commit found for rev %d" % findrev
+        sys.exit(1)
+    print sha
+    exit()
+
+if shards > 1:
+    # The workers run from inside the target directory
+    usersfile = os.path.abspath(usersfile)
+if externalsdump and externalsdump != '-':
+    externalsdump = os.path.abspath(externalsdump)
+if dumpfile and dumpfile != '-':
+    dumpfile = os.path.abspath(dumpfile)
+if externcache and exportexternals and not dumpfile:
+    if not os.path.exists(externcache):
+        os.makedirs(externcache)
+    externCache = ExternCache(externcache)
 userLookup = getUserLookup(usersfile)
+if metricsfile:
+    metrics.open(metricsfile)
+if svntimeout is not None:
+    svnClient = svnBackends[svnbackend](timeout=svntimeout, retries=svnretries)
+else:
+    svnClient = svnBackends[svnbackend]()
+externalsPool = ThreadPool(jobs) if jobs > 1 else None
+if externalsPool is not None:
+    jobOutput = sys.stdout = JobOutput(sys.stdout)
 
 #
 # Debug: check ancestry
@@ -488,44 +3375,67 @@ userLookup = getUserLookup(usersfile)
 if checkancestry:
     startrevnum = 0
     lastrev = getLastRevision(repo)
-    revnumbers = range(startrevnum, lastrev.number + 1)
     print "-- Ancestry for %s from %d to %d --" % (repo, lastrev.number, startrevnum)
     
-    prevRevUrl = ""
-    prevPegUrl = ""
-    for revnum in revnumbers:
-        printInfo = False
-        # Rev only
-        try:
-            url = getUrlForRepoAtRevision(repo, rev=revnum)
-        except CalledProcessError as e:
-            if e.stderr.find("Unable to find repository location") != -1\
-               or e.stderr.find("non-existent in revision") != -1:
-                url = "Not present in repo"
-            else:
-                raise
-        if url != prevRevUrl:
-            print "####\t%d r:\t%s" % (revnum, url)
-            prevRevUrl = url
-            printInfo = True
-            
-        # Peg only
-        try:
-            url = getUrlForRepoAtRevision(repo, peg=revnum)
-        except CalledProcessError as e:
-            if e.stderr.find("Unable to find repository location") != -1\
-               or e.stderr.find("non-existent in revision") != -1:
+    reposroot = getRepositoryRoot(rootrepo)
+    revisionIndex.load(reposroot, startrevnum, lastrev.number)
+    ancestry = AncestryHistory(revisionIndex, urlToRepositoryPath(repo), startrevnum, lastrev.number)
+    for revnum, events in ancestry.transitions():
+        for kind, path in events:
+            if path is None:
                 url = "Not present in repo"
             else:
-                raise
-        if url != prevPegUrl:
-            print "####\t%d p:\t%s" % (revnum, url)
-            prevPegUrl = url
-            printInfo = True
+                url = reposroot + urllib.quote(path)
+            print "####\t%d %s:\t%s" % (revnum, kind, url)
         
         # Print info for relevant changes
-        if printInfo:
-            text, errtext = readcall("svn log -r %d %s" % (revnum, rootrepo), printcommand=False, printstdout=True, printstderr=False)
+        if revnum in revisionIndex:
+            print formatLogEntry(revisionIndex.getEntry(revnum))
+    exit()
+
+#
+# Multi-target mode: one pass over the history feeds every --target
+#
+
+if targets:
+    conversions = [TargetConversion(*target) for target in targets]
+    for conversion in conversions:
+        conversion.open()
+    svnInfoCache.open(os.path.join(conversions[0].directory, '.git', 'info', 'svninfocache'))
+    lastrev = getLastRevision(rootrepo)
+    firstrevnum = min(conversion.startrevnum for conversion in conversions)
+    
+    print "-- Indexing revision metadata from rev %d to rev %d --" % (firstrevnum, lastrev.number)
+    reposroot = getRepositoryRoot(rootrepo)
+    with metrics.phase('index'):
+        revisionIndex.load(reposroot, firstrevnum, lastrev.number)
+        if exportexternals:
+            loadPropertyChanges(externalsdump)
+    print "-- Indexed %d revisions --" % len(revisionIndex)
+    
+    print "-- Planning which revisions to replay --"
+    for conversion in conversions:
+        conversion.start(lastrev.number)
+    while True:
+        pending = [conversion for conversion in conversions if conversion.nextrevnum is not None]
+        if not pending:
+            break
+        revnum = min(conversion.nextrevnum for conversion in pending)
+        for conversion in pending:
+            if conversion.nextrevnum == revnum:
+                print "-- %s --" % conversion.repo
+                repo, svnroot, exportTree, changedPaths, committer, revisionPlan, conversionState = conversion.activate()
+                replayRevision(revnum)
+                conversion.advance()
+    
+    for conversion in conversions:
+        conversion.finish(lastrev.number)
+    svnInfoCache.close()
+    if externCache is not None:
+        externCache.close()
+    print metrics.summary()
+    metrics.close()
+    print "-- Completed conversion of %d targets from SVN repo to flattened GIT repos --\n" % len(conversions)
     exit()
 
 print "-- Converting %s to %s --" % (repo, targetdir)
@@ -538,99 +3448,211 @@ print "-- Converting %s to %s --" % (repo, targetdir)
 if not os.path.exists(targetdir):
     os.mkdir(targetdir)
 os.chdir(targetdir)
-if not os.path.exists('.git'): 
-    call("git init", printcommand=False)
-    with open(".git/info/exclude", 'a') as gitignore:
-        gitignore.write("**/.svn/**\n")
-        gitignore.write(".commitmessage\n")
+changedPaths.setRoot(os.getcwd())
+# With --prefix the svn working copy lives in a subdirectory of the git work tree,
+# so every path git sees already has the prefix on it.
+svnroot = os.path.join(os.getcwd(), prefix) if prefix else os.getcwd()
+exportTree = ExportTree(svnroot) if exporttree else None
+initGitRepo()
+svnInfoCache.open(".git/info/svninfocache")
+conversionState = ConversionState(".git/info/state.db")
+if externCache is not None:
+    externCache.attach()
 
 #
 # Figure out which revisions to replay
 #
 
 revnumbers = None
-if os.path.exists('.git/info/progress'):
-    startrevnum = 0
-    with open('.git/info/progress', 'r') as gitprogress:
-        startrevnum = int(gitprogress.read())
-    lastrev = getLastRevision(rootrepo)
+progress = conversionState.getProgress()
+if progress is not None and shards > 1:
+    usagequit("--shards only works for a new conversion, %s already has one" % targetdir)
+spooleddump = None
+if dumpfile:
+    # A dump has the whole history, so everything svn would tell us comes from it instead.
+    if dumpfile == '-':
+        # It's read twice, and stdin can only be read once
+        spooleddump = dumpfile = os.path.join(os.getcwd(), '.git', 'info', 'dump')
+        with open(dumpfile, 'wb') as spool:
+            shutil.copyfileobj(sys.stdin, spool)
+    print "-- Indexing revision metadata from the dump --"
+    reposroot = rootrepo.rstrip('/')
+    with metrics.phase('index'):
+        with open(dumpfile, 'rb') as dumpstream:
+            revisionIndex.loadDump(dumpstream)
+    print "-- Indexed %d revisions --" % len(revisionIndex)
+    if not len(revisionIndex):
+        usagequit("No revisions in %s" % dumpfile)
+    youngestrevnum = max(revisionIndex.entries)
+    history = getLocationHistory(revisionIndex, urlToRepositoryPath(repo), min(revisionIndex.entries), youngestrevnum)
+    if not history:
+        usagequit("%s isn't in the dump" % repo)
+    creationrevnum = min(startrevnum for startrevnum, endrevnum, path in history)
+if revrange is not None:
+    startrevnum = revrange[0] if progress is None else max(progress, revrange[0])
+    lastrev = getRevision(revrange[1])
+    revnumbers = xrange(startrevnum, lastrev.number + 1)
+    print "-- Converting from rev %d to rev %d --" % (startrevnum, lastrev.number)
+elif progress is not None:
+    startrevnum = progress
+    lastrev = getRevision(youngestrevnum) if dumpfile else getLastRevision(rootrepo)
     revnumbers = xrange(startrevnum, lastrev.number + 1)
     print "-- Continuing from rev %d to rev %d --" % (startrevnum ,lastrev.number)
 else:
-    firstrev = getFirstRevision(repo)
-    lastrev = getLastRevision(rootrepo)
+    firstrev = getRevision(creationrevnum) if dumpfile else getFirstRevision(repo)
+    lastrev = getRevision(youngestrevnum) if dumpfile else getLastRevision(rootrepo)
     revnumbers = xrange(firstrev.number, lastrev.number + 1)
     print "-- Starting from scratch from rev %d to rev %d --" % (firstrev.number, lastrev.number)
 
+if not dumpfile:
+    print "-- Indexing revision metadata --"
+    reposroot = getRepositoryRoot(rootrepo)
+    with metrics.phase('index'):
+        revisionIndex.load(reposroot, revnumbers[0] if len(revnumbers) else lastrev.number, lastrev.number)
+    print "-- Indexed %d revisions --" % len(revisionIndex)
+if exportexternals and not dumpfile:
+    with metrics.phase('index'):
+        loadPropertyChanges(externalsdump)
+
+print "-- Planning which revisions to replay --"
+revisionPlan = RevisionPlan(revisionIndex, urlToRepositoryPath(repo), revnumbers[0] if len(revnumbers) else lastrev.number, lastrev.number)
+for startrevnum, endrevnum, path in revisionPlan.locations:
+    print "%s from rev %d to rev %d" % (path, startrevnum, endrevnum)
+
 
 #
-# replay every svn revision on the new git repo
+# Sharded mode: convert ranges of revisions in parallel, then chain them together
 #
 
+if shards > 1 and not dumpfile:
+    ranges = splitRevisions(revisionPlan, revnumbers, shards)
+    print "-- Converting %d shards --" % len(ranges)
+    workerargs = [sys.executable, os.path.abspath(sys.argv[0]), '--root', rootrepo, '--repo', repo[len(rootrepo):],
+                  '--users', usersfile, '--fast-import', '--jobs', str(jobs), '--svn-backend', svnbackend]
+    for remoterepo in remoterepos:
+        workerargs += ['--remote', remoterepo]
+    if not exportexternals:
+        workerargs.append('--no-externals')
+    if prefix:
+        workerargs += ['--prefix', prefix]
+    if exporttree:
+        workerargs.append('--no-working-copy')
+    if externalsdump and externalsdump != '-':
+        workerargs += ['--externals-dump', externalsdump]
+    if externCache is not None:
+        workerargs += ['--extern-cache', externcache]
+    if svntimeout is not None:
+        workerargs += ['--svn-timeout', str(svntimeout), '--svn-retries', str(svnretries)]
+    directories = convertShards(ranges, os.path.join(os.getcwd(), '.git', 'shards'), workerargs)
+    print "-- Chaining shards --"
+    committed = stitchShards(directories)
+    call("git reset -q --hard", printcommand=False)
+    conversionState.checkpoint(lastrev.number, committed)
+    conversionState.close()
+    svnInfoCache.close()
+    shutil.rmtree(os.path.join(os.getcwd(), '.git', 'shards'))
+    if externCache is not None:
+        externCache.detach()
+        externCache.close()
+    print "-- Completed sharded conversion from SVN repo to flattened GIT repo --\n"
+    exit()
 
-deleteAllSvnContentInCwd()
-for revnum in revnumbers:
-    print "-- Replaying revision %d --" % revnum
-    rev = getRevision(revnum)
-    
-    ignoreThisChange = False
-    
-    # If any externals change, nuke the entire repo and get the externals fresh.
-    # This way, we don't have to look into the history to figure out what to delete.
-    # Trust me this will be faster.
-    if exportexternals and didExternalsChange(revnum):
-        print "WARNING: Externals changed, nuking the entire repo."
-        deleteAllSvnContentInCwd()
+#
+# Dump mode: replay the dump stream straight into git, no working copy needed
+#
 
-    ignoreThisChange = updateProjectRootTo(rev)
-    
-    if not ignoreThisChange:
-        if exportexternals:
-            updateExternalsTo(rev.number)
+if dumpfile:
+    committer = GitFastImportBackend()
+    dumpstartrevnum = revnumbers[0] if len(revnumbers) else lastrev.number + 1
+    if progress is not None:
+        # The progress revision itself was already committed last time.
+        dumpstartrevnum += 1
+    replayer = DumpReplayer(committer, revisionPlan, dumpstartrevnum, prefix)
+    with open(dumpfile, 'rb') as dumpstream:
+        replayer.replay(dumpstream)
+    if spooleddump is not None:
+        os.remove(spooleddump)
+    committed = committer.commitIds()
+    committer.close()
+    svnInfoCache.close()
+    if replayer.lastrevnum is not None:
+        conversionState.checkpoint(replayer.lastrevnum, committed)
+    conversionState.close()
+    print "-- Completed conversion from SVN dump to flattened GIT repo --\n"
+    exit()
 
-        # Add everything. New files, modifications, deletions.
-        text, errtext = readcall("git add -f -u .", printcommand=False, printstdout=False, printstderr=False)
-        text, errtext = readcall("git add -f --all .", printcommand=False, printstdout=False, printstderr=False)
-        
-        
-        # Remove all .svn directories from the cache
-        text, errtext = readcall("git ls-files -i --exclude '**/.svn/wc.db' ", printcommand=False, printstdout=False, printstderr=False)
-        svndirs = set()
-        for line in text.splitlines():
-            match = re.search(r'^(.*\.svn)/', line)
-            if match:
-                svndirs.add(match.group(1))
-        svndirs = list(svndirs)            
-        while svndirs:
-            cmd = "git rm --cached -r"
-            dirsperline = 10
-            while svndirs and dirsperline > 0:
-                cmd += " \"%s\"" % svndirs.pop()
-                dirsperline -= 1
-            
-            text, errtext = readcall(cmd, printcommand=False, printstdout=False, printstderr=False)
-        
-        
-        with open(".git/info/commitmessage", 'w') as commitmessage:
-            commitmessage.write("%s\n\nExported from rev %d %s" % (rev.log, rev.number, repo))
-            
-        try:
-            text, errtext = readcall('git commit --author="%s" --date="%s" --file=.git/info/commitmessage' % (rev.user, rev.date), printcommand=False, printstdout=False, printstderr=False)
-            print text
-            print >> sys.stderr, errtext
-        except CalledProcessError as e:
-            if e.stdout.find("nothing to commit") != -1:
-                pass
-            else:
-                raise
-        
-        os.remove(".git/info/commitmessage")
+#
+# replay every svn revision on the new git repo
+#
+
+
+workingCopy = None
+if progress is not None:
+    workingCopy = conversionState.loadWorkingCopy(changedPaths.root)
+if workingCopy is not None and os.path.exists(os.path.join(svnroot, '.svn')):
+    # svn may have moved the working copy past the last checkpoint, so the first
+    # commit looks at the whole tree instead of trusting what svn reports.
+    print "-- Keeping the working copy from rev %d --" % workingCopy[0]
+    with previousExternsLock:
+        previousExterns.update(workingCopy[1])
+    changedPaths.everything()
+else:
+    deleteAllSvnContentInCwd()
+if fastimport:
+    committer = GitFastImportBackend()
+else:
+    committer = GitIndexBackend(svnmetadata=exportTree is None or exportexternals)
+if exportTree is not None and prefetchdepth > 0:
+    prefetcher = Prefetcher(prefetchRevisions(revnumbers), prepareRevision, prefetchdepth)
+for revnum in revisionPlan.select(revnumbers):
+    replayRevision(revnum)
 
-    with open(".git/info/progress", 'w') as gitprogress:
-        gitprogress.write(str(rev.number))
+#
+# Follow mode: stay up and convert new revisions as they arrive
+#
 
-print "-- Correcting commit datestamps --"
-call("git filter-branch -f --env-filter 'GIT_COMMITTER_DATE=$GIT_AUTHOR_DATE; export GIT_COMMITTER_DATE'", printcommand=False)
+# Only the number from here on: a followed revision may be by an author the users file doesn't know.
+lastrevnum = lastrev.number
+if follow:
+    # Everything stays as it is: the working copy, externs, caches and committer.
+    notifications = openNotifications(os.path.join('.git', 'info', 'follow'))
+    while True:
+        if committer.checkpoint(force=True):
+            conversionState.checkpoint(lastrevnum, committer.commitIds())
+        print "-- Following %s from rev %d --" % (rootrepo, lastrevnum)
+        try:
+            youngest = waitForRevisions(rootrepo, lastrevnum, pollseconds, notifications)
+        except KeyboardInterrupt:
+            print "-- Stopped following --"
+            break
+        revnumbers = xrange(lastrevnum + 1, youngest + 1)
+        print "-- Indexing rev %d to rev %d --" % (revnumbers[0], youngest)
+        with metrics.phase('index'):
+            revisionIndex.load(reposroot, revnumbers[0], youngest)
+            if exportexternals:
+                propertyChanges.loadLog(revisionIndex, revnumbers)
+        # Only the new revisions need planning, but keep watching the same externs
+        externpaths = revisionPlan.externpaths
+        revisionPlan = RevisionPlan(revisionIndex, urlToRepositoryPath(repo), revnumbers[0], youngest)
+        revisionPlan.externpaths = externpaths
+        if prefetcher is not None:
+            prefetcher = Prefetcher(prefetchRevisions(revnumbers, replayfirst=False), prepareRevision, prefetchdepth)
+        for revnum in revisionPlan.select(revnumbers, replayfirst=False):
+            replayRevision(revnum)
+        lastrevnum = youngest
+    os.close(notifications)
+    os.remove(os.path.join('.git', 'info', 'follow'))
+
+committed = committer.commitIds()
+committer.close()
+svnInfoCache.close()
+conversionState.checkpoint(lastrevnum, committed)
+conversionState.close()
+if externCache is not None:
+    externCache.detach()
+    externCache.close()
+print metrics.summary()
+metrics.close()
 
 print "-- Completed conversion from SVN repo to flattened GIT repo --\n"
 
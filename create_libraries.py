@@ -2,7 +2,8 @@
 
 # Clone all of our SVN projects to git repos, then merge them into a "libraries" git repo.
 
-import os, subprocess, shlex
+import os, subprocess, shlex, time, multiprocessing
+from git_date_merge import datemerge
 
 def call(cmd):
     print cmd
@@ -14,6 +15,26 @@ def readcall(cmd):
     args = shlex.split(cmd.encode('utf8'))
     return subprocess.check_output(args)
 
+def exportlibrary(task):
+    """Convert one library into its own directory. Runs in a worker process, so
+    everything it needs is passed in and nothing depends on the current directory.
+    When logfile is set, the converter's output goes there instead of the console."""
+    modname, cmdstr, logfile = task
+    args = shlex.split(cmdstr.encode('utf8'))
+    start = time.time()
+    try:
+        if logfile:
+            with open(logfile, 'w') as log:
+                retval = subprocess.call(args, stdout=log, stderr=subprocess.STDOUT)
+        else:
+            print cmdstr
+            retval = subprocess.call(args)
+    except OSError as e:
+        return modname, str(e), time.time() - start
+    if retval != 0:
+        return modname, "convert_to_git exited with %d" % retval, time.time() - start
+    return modname, None, time.time() - start
+
 def createlibraries(    rootrepo,
                         libraries,
                         targetdir='libraries_build',
@@ -21,11 +42,19 @@ def createlibraries(    rootrepo,
                         gitfilterprefix=None,
                         gitcherrysort=None,
                         gitusers=None,
-                        converttogit=None ):
-    if not gitfilterprefix:
-        gitfilterprefix = os.path.abspath('git_filter_prefix.sh')
-    if not gitcherrysort:
-        gitcherrysort = os.path.abspath('git_cherry_sort.sh')
+                        converttogit=None,
+                        jobs=1,
+                        externals=False,
+                        singlepass=False,
+                        convertjobs=1 ):
+    """Convert every library and merge them into one "libraries" repo. jobs is how many
+    libraries convert at a time, convertjobs is each convert_to_git.py's --jobs. With
+    singlepass, a single convert_to_git.py run converts them all."""
+    # Still accepted so existing callers keep working, but nothing runs them anymore
+    if gitfilterprefix:
+        print "createlibraries: gitfilterprefix is deprecated and ignored, convert_to_git.py --prefix does its job"
+    if gitcherrysort:
+        print "createlibraries: gitcherrysort is deprecated and ignored, git_date_merge.py does its job"
     if not gitusers:
         gitusers = os.path.abspath('gitusers.txt')
     if not converttogit:
@@ -34,36 +63,59 @@ def createlibraries(    rootrepo,
     # Make a subfolder to contain all these wild shenanigans
     if not os.path.exists(targetdir):
         os.mkdir(targetdir)
-    os.chdir(targetdir)
-    rootleveldir = os.getcwd()
+    rootleveldir = os.path.abspath(targetdir)
+    # Libraries often pin the same externs, so they all share one snapshot cache.
+    externcache = os.path.join(rootleveldir, "extern_cache")
 
-    for modname, url in libraries.iteritems():
-        os.chdir(rootleveldir)
-        dirname = os.path.abspath("export_" + modname)
-        outputdirname = os.path.abspath("filtered_" + modname)
-        
-        # Export each library from the svn repo
-        print "\n-- Exporting library %s --\n" % modname
-        cmdstr = "%s --no-externals --root %s --repo %s --users %s" % (converttogit, rootrepo, url, gitusers)
-        for remote in remoterepos:
-            cmdstr += " --remote %s" % remote
-        cmdstr += " %s" % dirname
-        retval = call(cmdstr)
-        if retval != 0:
-            raise RuntimeError("convert_to_git error")
-            
-        # Copy the exported library somewhere else to be filtered.
-        if os.path.exists(outputdirname):
-            call("rm -rf %s" % outputdirname)
-        call("cp -R %s %s" % (dirname, outputdirname))
+    options = "--root %s --users %s --jobs %d" % (rootrepo, gitusers, convertjobs)
+    if externals:
+        options += " --extern-cache %s" % externcache
+    else:
+        options += " --no-externals"
+    for remote in remoterepos:
+        options += " --remote %s" % remote
 
-        # Filter each library's commits into a subfolder
-        print "\n-- Filtering library %s --\n" % modname
-        os.chdir(outputdirname)
-        retval = call("%s %s" % (gitfilterprefix, modname))
-        if retval != 0:
-            raise RuntimeError("git_filter_prefix error")
-            
+    # Export each library from the svn repo, already inside its own subfolder
+    tasks = []
+    if singlepass:
+        # One pass over the history feeds every library's repo
+        cmdstr = "%s %s" % (converttogit, options)
+        for modname, url in libraries.iteritems():
+            cmdstr += " --target %s:%s:%s" % (url, modname, os.path.join(rootleveldir, "export_" + modname))
+        tasks.append(("all", cmdstr, None))
+    else:
+        for modname, url in libraries.iteritems():
+            dirname = os.path.join(rootleveldir, "export_" + modname)
+            cmdstr = "%s %s --repo %s --prefix %s %s" % (converttogit, options, url, modname, dirname)
+            logfile = None
+            if jobs > 1:
+                logfile = os.path.join(rootleveldir, "export_%s.log" % modname)
+            tasks.append((modname, cmdstr, logfile))
+
+    if singlepass:
+        print "\n-- Exporting %d libraries in one pass --\n" % len(libraries)
+    else:
+        print "\n-- Exporting %d libraries, %d at a time --\n" % (len(libraries), jobs)
+    if jobs > 1 and len(tasks) > 1:
+        for modname, cmdstr, logfile in tasks:
+            print "%s: %s (log in %s)" % (modname, cmdstr, logfile)
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(exportlibrary, tasks)
+    else:
+        pool = None
+        results = (exportlibrary(task) for task in tasks)
+
+    failures = []
+    for done, (modname, error, seconds) in enumerate(results, 1):
+        status = "done" if error is None else "FAILED: %s" % error
+        print "-- [%d/%d] Library %s %s after %.0f seconds --" % (done, len(tasks), modname, status, seconds)
+        if error is not None:
+            failures.append((modname, error))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if failures:
+        raise RuntimeError("convert_to_git failed for %d libraries:\n%s" % (len(failures), "\n".join("  %s: %s" % failure for failure in failures)))
             
     # Make a "libraries" git repo that we'll fill with these libraries
     os.chdir(rootleveldir)
@@ -80,22 +132,12 @@ def createlibraries(    rootrepo,
     call("git add .gitignore")
     call("git commit -m 'Create libraries repo'")
 
-    # Pull each library
-    for modname, url in libraries.iteritems():
-        print "\n-- Pulling library %s --\n" % modname
-        os.chdir(rootleveldir)
-        dirname = os.path.abspath("filtered_" + modname)
-        os.chdir(librariesrepo)
-        retval = call("git pull --no-edit %s" % (dirname))
-        if retval != 0:
-            raise RuntimeError("git pull error")
-
-    # Merge the git repo
-    print "\n-- Sorting and Filtering \"libraries\" repo --\n"
+    # Interleave every library's history by date, in one pass
+    print "\n-- Merging libraries into \"libraries\" repo --\n"
+    dirnames = [os.path.join(rootleveldir, "export_" + modname) for modname in libraries]
     os.chdir(librariesrepo)
-    retval = call(gitcherrysort)
-    if retval != 0:
-        raise RuntimeError("git_cherry_sort error")
+    datemerge(dirnames)
+    call("git reset --hard")
         
 if __name__ == '__main__':
     rootrepo = "file:///home/chrisknyfe/migration/localsvn"
@@ -107,6 +149,6 @@ if __name__ == '__main__':
                 "toolbox":                  "/trunk/toolbox/",
                 }
                 
-    createlibraries(rootrepo, libraries)
+    createlibraries(rootrepo, libraries, jobs=min(len(libraries), multiprocessing.cpu_count()))
             
         
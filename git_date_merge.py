@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# Interleave the histories of several git repos into one linear history, sorted by author date.
+# A faster replacement for pulling every repo and running git_cherry_sort.sh.
+
+import sys, os, subprocess, getopt, heapq
+from collections import namedtuple
+
+usagestr = \
+"""
+Usage: python git_date_merge.py [--branch BRANCH] [--chain] SOURCEREPO [SOURCEREPO ...]
+
+Read the history of every SOURCEREPO with 'git fast-export' and write it to BRANCH
+(default refs/heads/master) of the git repo in the current directory as one linear
+history, ordered by author date. Each source should only touch its own
+subdirectory, e.g. because it was converted with convert_to_git.py --prefix.
+
+With --chain the sources are appended one after another instead, each one carrying
+on from where the one before it stopped.
+""".strip()
+
+Commit = namedtuple("Commit", ["author", "committer", "when", "message", "changes"])
+
+def readData(stream, line):
+    """Read the payload of a 'data <length>' command."""
+    if not line.startswith('data '):
+        raise ValueError("Expected a data command, got %r" % line)
+    data = stream.read(int(line[5:]))
+    return data
+
+def readCommits(stream):
+    """Yield each commit of a 'git fast-export --no-data' stream as it's read."""
+    line = stream.readline()
+    while line:
+        line = line.rstrip('\n')
+        if not line.startswith('commit '):
+            line = stream.readline()
+            continue
+        author = None
+        committer = None
+        message = ""
+        changes = []
+        line = stream.readline()
+        while line:
+            line = line.rstrip('\n')
+            if line.startswith('author '):
+                author = line[7:]
+            elif line.startswith('committer '):
+                committer = line[10:]
+            elif line.startswith('data '):
+                message = readData(stream, line)
+            elif line[:2] in ('M ', 'D ') or line == 'deleteall':
+                changes.append(line)
+            elif line == '' and committer is not None:
+                break
+            elif line.startswith('commit ') or line.startswith('reset ') or line.startswith('tag '):
+                break
+            # mark, from, merge, encoding and original-oid aren't needed for a linear history
+            line = stream.readline()
+        if author is None:
+            author = committer
+        when = author.rsplit(' ', 2)
+        yield Commit(author=author, committer=committer, when=(int(when[1]), when[2]), message=message, changes=changes)
+        if line.startswith('commit '):
+            continue
+        line = stream.readline()
+
+def sortedCommits(index, process):
+    """Key each commit by (author time, source, sequence) so heapq.merge keeps every
+    source's own order and breaks ties by source."""
+    for sequence, commit in enumerate(readCommits(process.stdout)):
+        yield (commit.when[0], index, sequence, commit)
+
+def borrowObjects(sources):
+    """Borrow the sources' objects instead of copying every blob through fast-export.
+    Returns what's needed to put the alternates file back afterwards."""
+    gitdir = subprocess.check_output(['git', 'rev-parse', '--git-dir']).strip()
+    alternates = os.path.join(gitdir, 'objects', 'info', 'alternates')
+    oldalternates = None
+    if os.path.exists(alternates):
+        with open(alternates, 'r') as f:
+            oldalternates = f.read()
+    with open(alternates, 'a') as f:
+        for source in sources:
+            objects = subprocess.check_output(['git', 'rev-parse', '--git-dir'], cwd=source).strip()
+            f.write(os.path.join(source, objects, 'objects') + '\n')
+    return alternates, oldalternates
+
+def returnObjects(borrowed):
+    """Make the repo stand on its own again."""
+    alternates, oldalternates = borrowed
+    subprocess.check_call(['git', 'repack', '-a', '-d', '-q'])
+    if oldalternates is None:
+        os.remove(alternates)
+    else:
+        with open(alternates, 'w') as f:
+            f.write(oldalternates)
+
+def branchParent(branch):
+    if subprocess.call(['git', 'rev-parse', '--verify', '-q', branch], stdout=open(os.devnull, 'w')) == 0:
+        return "%s^0" % branch
+    return None
+
+def writeCommit(out, branch, commit, committer, parent=None, mark=None):
+    out.write("commit %s\n" % branch)
+    if mark is not None:
+        out.write("mark :%d\n" % mark)
+    out.write("author %s\n" % commit.author)
+    out.write("committer %s\n" % committer)
+    out.write("data %d\n%s\n" % (len(commit.message), commit.message))
+    if parent:
+        out.write("from %s\n" % parent)
+
+def datemerge(sources, branch='refs/heads/master'):
+    """Merge the default branches of sources into branch of the repo in the current directory."""
+    sources = [os.path.abspath(source) for source in sources]
+    borrowed = borrowObjects(sources)
+    parent = branchParent(branch)
+
+    exporters = [subprocess.Popen(['git', 'fast-export', '--no-data', 'HEAD'], stdout=subprocess.PIPE, cwd=source) for source in sources]
+    importer = subprocess.Popen(['git', 'fast-import', '--quiet'], stdin=subprocess.PIPE)
+    out = importer.stdin
+
+    # What each source has written so far, in case it ever asks for a deleteall.
+    written = [set() for source in sources]
+    count = 0
+    for when, index, sequence, commit in heapq.merge(*[sortedCommits(i, p) for i, p in enumerate(exporters)]):
+        # Committer date is the author date, like git_cherry_sort.sh's final filter-branch.
+        writeCommit(out, branch, commit, "%s %d %s" % (commit.committer.rsplit(' ', 2)[0], commit.when[0], commit.when[1]), parent)
+        parent = None
+        for change in commit.changes:
+            if change == 'deleteall':
+                for path in written[index]:
+                    out.write("D %s\n" % path)
+                written[index] = set()
+                continue
+            if change.startswith('M '):
+                written[index].add(change.split(' ', 3)[3])
+            else:
+                written[index].discard(change[2:])
+            out.write(change + "\n")
+        out.write("\n")
+        count += 1
+
+    out.close()
+    importer.wait()
+    for p in exporters:
+        p.wait()
+        if p.returncode != 0:
+            raise RuntimeError("git fast-export failed")
+    if importer.returncode != 0:
+        raise RuntimeError("git fast-import failed")
+
+    returnObjects(borrowed)
+    print "Merged %d commits from %d repos into %s" % (count, len(sources), branch)
+    return count
+
+def readTree(revision, cwd=None):
+    return subprocess.check_output(['git', 'rev-parse', '%s^{tree}' % revision], cwd=cwd).strip()
+
+def chain(sources, branch='refs/heads/master'):
+    """Append the default branches of sources to branch one after another.
+    
+    Each source's first commit replaces the whole tree, so a source can start from
+    a snapshot of where the one before it stopped. A first commit that wouldn't
+    change anything is dropped. Returns (source index, commit index in source) for
+    every commit written, in order."""
+    sources = [os.path.abspath(source) for source in sources]
+    borrowed = borrowObjects(sources)
+    parent = branchParent(branch)
+    tiptree = readTree(parent) if parent else None
+
+    importer = subprocess.Popen(['git', 'fast-import', '--quiet'], stdin=subprocess.PIPE)
+    out = importer.stdin
+    written = []
+    for index, source in enumerate(sources):
+        root = subprocess.check_output(['git', 'rev-list', '--max-parents=0', 'HEAD'], cwd=source).split()[0]
+        skipfirst = readTree(root, source) == tiptree
+        exporter = subprocess.Popen(['git', 'fast-export', '--no-data', 'HEAD'], stdout=subprocess.PIPE, cwd=source)
+        for sequence, commit in enumerate(readCommits(exporter.stdout)):
+            if sequence == 0 and skipfirst:
+                continue
+            writeCommit(out, branch, commit, commit.committer, parent)
+            parent = None
+            if sequence == 0:
+                out.write("deleteall\n")
+            for change in commit.changes:
+                out.write(change + "\n")
+            out.write("\n")
+            written.append((index, sequence))
+        exporter.wait()
+        if exporter.returncode != 0:
+            raise RuntimeError("git fast-export failed in %s" % source)
+        tiptree = readTree('HEAD', source)
+
+    out.close()
+    importer.wait()
+    if importer.returncode != 0:
+        raise RuntimeError("git fast-import failed")
+    returnObjects(borrowed)
+    print "Chained %d commits from %d repos onto %s" % (len(written), len(sources), branch)
+    return written
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], '', ['branch=', 'chain'])
+    except getopt.GetoptError as err:
+        print str(err)
+        print usagestr
+        sys.exit(2)
+    branch = 'refs/heads/master'
+    merge = datemerge
+    for o, a in opts:
+        if o == '--branch':
+            branch = a
+        elif o == '--chain':
+            merge = chain
+    if not args:
+        print usagestr
+        sys.exit(2)
+    merge(args, branch)
@@ -8,3 +8,12 @@ chmod +x localsvn/hooks/pre-revprop-change
 svnsync init file:///home/chrisknyfe/migration/localsvn https://pl3.projectlocker.com/Team/project/svn/
 svnsync sync file:///home/chrisknyfe/migration/localsvn
 
+
+# Wake up a running 'convert_to_git.py --follow export_dir' whenever the mirror gets a
+# revision. svnsync copies a revision's author and date after committing it, so the
+# post-revprop-change hook is needed as well as post-commit.
+for hook in post-commit post-revprop-change; do
+    echo '#!/bin/bash' > localsvn/hooks/$hook
+    echo 'python /home/chrisknyfe/migration/convert_to_git.py --notify /home/chrisknyfe/migration/export_dir' >> localsvn/hooks/$hook
+    chmod +x localsvn/hooks/$hook
+done
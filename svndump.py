@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+# Streaming reader for 'svnadmin dump' / 'svnrdump dump' output, including --deltas dumps.
+
+import zlib
+from collections import namedtuple
+
+DumpRecord = namedtuple("DumpRecord", ["headers", "props", "propdeletes", "text"])
+
+#
+# Record parsing
+#
+
+def readHeaders(stream):
+    """Read 'Key: value' lines up to the next blank line. Returns None at end of stream."""
+    headers = {}
+    while True:
+        line = stream.readline()
+        if not line:
+            if headers:
+                raise ValueError("Dump stream ended in the middle of a header block")
+            return None
+        line = line.rstrip('\n')
+        if not line:
+            if headers:
+                return headers
+            # Records are separated by any number of blank lines.
+            continue
+        key, sep, value = line.partition(': ')
+        if not sep:
+            raise ValueError("Malformed dump header line: %r" % line)
+        headers[key] = value
+
+def readExactly(stream, length):
+    data = stream.read(length)
+    if len(data) != length:
+        raise ValueError("Dump stream ended early, wanted %d bytes and got %d" % (length, len(data)))
+    return data
+
+def skipExactly(stream, length, chunksize=1 << 20):
+    """Read past length bytes without keeping them."""
+    while length > 0:
+        data = stream.read(min(length, chunksize))
+        if not data:
+            raise ValueError("Dump stream ended early, %d bytes short" % length)
+        length -= len(data)
+
+def parseProps(data):
+    """Parse a property block. Returns (props, deleted property names)."""
+    props = {}
+    deletes = []
+    pos = 0
+    while True:
+        end = data.index('\n', pos)
+        line = data[pos:end]
+        pos = end + 1
+        if line == "PROPS-END":
+            return props, deletes
+        kind, length = line.split(' ')
+        length = int(length)
+        key = data[pos:pos + length]
+        pos += length + 1
+        if kind == 'D':
+            deletes.append(key)
+        elif kind == 'K':
+            end = data.index('\n', pos)
+            kind, length = data[pos:end].split(' ')
+            length = int(length)
+            pos = end + 1
+            if kind != 'V':
+                raise ValueError("Expected a property value after key %r" % key)
+            props[key] = data[pos:pos + length]
+            pos += length + 1
+        else:
+            raise ValueError("Unknown property record %r" % line)
+
+def readRecords(stream, skiptext=False):
+    """Yield every record in a dump stream, one at a time, as a DumpRecord. With
+    skiptext, file contents are read past instead of kept, and text is always None."""
+    while True:
+        headers = readHeaders(stream)
+        if headers is None:
+            return
+        propslength = int(headers.get('Prop-content-length', 0))
+        textlength = headers.get('Text-content-length')
+        contentlength = headers.get('Content-length')
+        if contentlength is None:
+            contentlength = propslength + int(textlength or 0)
+        contentlength = int(contentlength)
+        if skiptext:
+            content = readExactly(stream, propslength) if propslength else ""
+            skipExactly(stream, contentlength - propslength)
+            textlength = None
+        else:
+            content = readExactly(stream, contentlength) if contentlength else ""
+
+        props = None
+        propdeletes = []
+        if 'Prop-content-length' in headers:
+            props, propdeletes = parseProps(content[:propslength])
+        text = None
+        if textlength is not None:
+            text = content[propslength:propslength + int(textlength)]
+        yield DumpRecord(headers=headers, props=props, propdeletes=propdeletes, text=text)
+
+#
+# svndiff
+#
+
+def readVarint(data, pos):
+    value = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value = (value << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            return value, pos
+
+def decompressSection(data, version):
+    """svndiff1 sections carry their original length and may be zlib-compressed."""
+    if version == 0:
+        return data
+    length, pos = readVarint(data, 0)
+    if len(data) - pos == length:
+        return data[pos:]
+    return zlib.decompress(data[pos:])
+
+def applySvndiff(source, delta):
+    """Apply an svndiff0 or svndiff1 delta to source and return the target text."""
+    if delta[:3] != "SVN":
+        raise ValueError("Not an svndiff delta")
+    version = ord(delta[3])
+    if version not in (0, 1):
+        raise ValueError("Unsupported svndiff version %d" % version)
+    target = []
+    pos = 4
+    while pos < len(delta):
+        sourceoffset, pos = readVarint(delta, pos)
+        sourcelength, pos = readVarint(delta, pos)
+        targetlength, pos = readVarint(delta, pos)
+        instructionslength, pos = readVarint(delta, pos)
+        newdatalength, pos = readVarint(delta, pos)
+        instructions = decompressSection(delta[pos:pos + instructionslength], version)
+        pos += instructionslength
+        newdata = decompressSection(delta[pos:pos + newdatalength], version)
+        pos += newdatalength
+
+        view = source[sourceoffset:sourceoffset + sourcelength]
+        window = bytearray()
+        newpos = 0
+        ipos = 0
+        while ipos < len(instructions):
+            byte = ord(instructions[ipos])
+            ipos += 1
+            action = byte >> 6
+            length = byte & 0x3f
+            if length == 0:
+                length, ipos = readVarint(instructions, ipos)
+            if action == 0:
+                offset, ipos = readVarint(instructions, ipos)
+                window += view[offset:offset + length]
+            elif action == 1:
+                offset, ipos = readVarint(instructions, ipos)
+                if offset + length <= len(window):
+                    window += window[offset:offset + length]
+                else:
+                    # Target copies may overlap what they're producing, so go byte by byte.
+                    for i in xrange(length):
+                        window.append(window[offset + i])
+            elif action == 2:
+                window += newdata[newpos:newpos + length]
+                newpos += length
+            else:
+                raise ValueError("Invalid svndiff instruction")
+        if len(window) != targetlength:
+            raise ValueError("svndiff window produced %d bytes, expected %d" % (len(window), targetlength))
+        target.append(str(window))
+    return "".join(target)